@@ -0,0 +1,307 @@
+"""
+This module benchmarks the hot paths of the presentation
+versions that serve the names API (versions 3 to 7).
+
+Each version is loaded with a names data structure of each size,
+and driven both through the Flask test client and through a
+real local server, timing list, get, put, post and delete
+requests. Every version and size runs in its own process, so
+the versions' modules (presentation, model, store...) never clash.
+
+The results are written as JSON, so runs can be compared:
+
+    python bench.py --output results.json
+    python bench.py --versions version_6 version_7 --sizes 10 10000 --ops list get
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+
+# where the version directories are
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the versions serving the names API, and the operations each one has
+VERSION_OPS = {
+    "version_3": ["list"],
+    "version_4": ["list", "get", "put", "post", "delete"],
+    "version_5": ["list", "get", "put", "post", "delete"],
+    "version_6": ["list", "get", "put", "post", "delete"],
+    "version_7": ["list", "get", "put", "post", "delete"]
+}
+OPS = ["list", "get", "put", "post", "delete"]
+MODES = ["client", "server"]
+DEFAULT_SIZES = [10, 10000, 1000000]
+
+FIRST_NAMES = ["Doug", "Kevin", "Bunny", "Ham", "Bill", "Ada", "Grace", "Alan", "Linus", "Guido"]
+
+
+def make_records(size):
+    """
+    Generate size name records keyed by last name
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rng = random.Random(size)
+    return {
+        "Name{:07d}".format(i): {
+            "fname": rng.choice(FIRST_NAMES),
+            "lname": "Name{:07d}".format(i),
+            "timestamp": timestamp
+        }
+        for i in range(size)
+    }
+
+
+def load_version(version, records):
+    """
+    Import a version's application and load records into it
+
+    :return:        the Flask application
+    """
+    version_path = os.path.join(CODE_PATH, version)
+    sys.path.insert(0, version_path)
+
+    if version == "version_7":
+        # point the model at a scratch database before it's imported
+        handle, database = tempfile.mkstemp(suffix=".db")
+        os.close(handle)
+        os.environ["NAMES_DATABASE_URI"] = "sqlite:///" + database
+
+        import presentation
+        from model import (
+            Name,
+            db
+        )
+        rows = [
+            {"lname": record["lname"], "fname": record["fname"], "timestamp": datetime.now()}
+            for record in records.values()
+        ]
+        with presentation.app.app_context():
+            for start in range(0, len(rows), 10000):
+                db.session.execute(Name.__table__.insert(), rows[start:start + 10000])
+            db.session.commit()
+        return presentation.app
+
+    import presentation
+    if version == "version_6":
+        from store import NamesStore
+        presentation.LIST_OF_NAMES = NamesStore(records)
+    else:
+        presentation.LIST_OF_NAMES = records
+    return presentation.app
+
+
+class TestClientDriver(object):
+    """
+    This class sends requests through the Flask test client
+    """
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None):
+        rsp = self.client.open(path, method=method, json=body)
+        rsp.get_data()
+        return rsp.status_code
+
+    def close(self):
+        pass
+
+
+class ServerDriver(object):
+    """
+    This class runs the application in a local threaded server,
+    and sends it requests over a keep-alive HTTP connection
+    """
+    def __init__(self, app):
+        from werkzeug.serving import (
+            WSGIRequestHandler,
+            make_server
+        )
+
+        class RequestHandler(WSGIRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=RequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.connection = http.client.HTTPConnection("127.0.0.1", self.server.server_port)
+
+    def request(self, method, path, body=None):
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        self.connection.request(method, path, body=body, headers=headers)
+        rsp = self.connection.getresponse()
+        rsp.read()
+        return rsp.status
+
+    def close(self):
+        self.connection.close()
+        self.server.shutdown()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def time_op(driver, op, names, max_requests, max_seconds):
+    """
+    Time requests of one operation
+
+    :param names:   {"existing": [last names], "created": [last names]},
+                    post adds the names it creates to created, and
+                    delete removes them again
+    :return:        the result dictionary for the operation
+    """
+    rng = random.Random(op)
+    last_names = names["existing"]
+    timings = []
+    errors = 0
+    started = time.perf_counter()
+    for i in range(max_requests):
+        if op == "list":
+            args = ("GET", "/api/names")
+        elif op == "get":
+            args = ("GET", "/api/names/" + rng.choice(last_names))
+        elif op == "put":
+            args = ("PUT", "/api/names/" + rng.choice(last_names), {"fname": "Updated"})
+        elif op == "post":
+            last_name = "Bench{:07d}".format(i)
+            names["created"].append(last_name)
+            args = ("POST", "/api/names", {"lname": last_name, "fname": "Bench"})
+        else:
+            # delete the names the post operation created
+            if not names["created"]:
+                break
+            args = ("DELETE", "/api/names/" + names["created"].pop())
+
+        start = time.perf_counter()
+        status = driver.request(*args)
+        timings.append(time.perf_counter() - start)
+        if status >= 400:
+            errors += 1
+        if time.perf_counter() - started > max_seconds:
+            break
+
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    return {
+        "op": op,
+        "requests": len(timings),
+        "errors": errors,
+        "seconds": round(elapsed, 6),
+        "rps": round(len(timings) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 4) if timings else None,
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 4) if timings else None
+    }
+
+
+def run_one(version, size, modes, ops, max_requests, max_seconds):
+    """
+    Benchmark one version at one size, in this process
+    """
+    records = make_records(size)
+    app = load_version(version, records)
+    app.logger.disabled = True
+    names = {"existing": list(records), "created": []}
+    del records
+
+    results = []
+    for mode in modes:
+        driver = TestClientDriver(app) if mode == "client" else ServerDriver(app)
+        try:
+            for op in ops:
+                if op not in VERSION_OPS[version]:
+                    continue
+                result = time_op(driver, op, names, max_requests, max_seconds)
+                result.update(version=version, size=size, mode=mode)
+                results.append(result)
+        finally:
+            driver.close()
+
+    # remove version 7's scratch database
+    database = os.environ.get("NAMES_DATABASE_URI", "")
+    if database.startswith("sqlite:///"):
+        os.remove(database[len("sqlite:///"):])
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=CODE_PATH, stderr=subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the names API versions")
+    parser.add_argument("--versions", nargs="+", default=sorted(VERSION_OPS), choices=sorted(VERSION_OPS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("--modes", nargs="+", default=MODES, choices=MODES)
+    parser.add_argument("--ops", nargs="+", default=OPS, choices=OPS)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="most requests timed per operation (default 500)")
+    parser.add_argument("--seconds", type=float, default=5.0,
+                        help="most seconds spent per operation (default 5)")
+    parser.add_argument("--output", help="file to write the JSON results to, default stdout")
+    parser.add_argument("--run-one", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # a child process benchmarking a single version and size
+    if args.run_one:
+        results = run_one(args.versions[0], args.sizes[0], args.modes, args.ops, args.requests, args.seconds)
+        json.dump(results, sys.stdout)
+        return
+
+    results = []
+    for version in args.versions:
+        for size in args.sizes:
+            sys.stderr.write("benchmarking {} with {} names\n".format(version, size))
+            command = [
+                sys.executable, os.path.abspath(__file__), "--run-one",
+                "--versions", version, "--sizes", str(size),
+                "--modes"] + args.modes + ["--ops"] + args.ops + [
+                "--requests", str(args.requests), "--seconds", str(args.seconds)
+            ]
+            output = subprocess.check_output(command, cwd=os.path.join(CODE_PATH, version))
+            results.extend(json.loads(output.decode("utf-8")))
+
+    report = {
+        "meta": {
+            "started": datetime.now().isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "requests": args.requests,
+            "seconds": args.seconds
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+# if we're running in stand alone mode, run the benchmarks
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+This module checks version 7 never serves a names list under the
+validators of another version of it, while a second Model, standing
+in for another worker, writes names the cache doesn't hear about.
+After each write it reads the list a few times, a random part of
+the cache's time to live apart, sometimes with the If-None-Match
+of the last list it got, and checks:
+
+    every 200's ETag counts the names in its body
+    once the cache's entries have expired, the list is the one in
+    the database
+
+The process exits with status 1 if anything failed.
+
+    python list_consistency.py --writes 200 --ttl 0.2
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# where the version directories are
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the most failures reported
+MAX_FAILURES = 20
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check version 7's list bodies match their validators")
+    parser.add_argument("--writes", type=int, default=200, help="writes made behind the cache (default 200)")
+    parser.add_argument("--reads", type=int, default=4, help="reads of the list after each write (default 4)")
+    parser.add_argument("--ttl", type=float, default=0.2, help="the model cache's time to live (default 0.2)")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    os.environ["NAMES_DATABASE_URI"] = "sqlite:///" + os.path.join(directory, "names.db")
+    os.environ["NAMES_CACHE_TTL"] = str(args.ttl)
+    sys.path.insert(0, os.path.join(CODE_PATH, "version_7"))
+    from model import Model
+    from presentation import (
+        MODEL,
+        app,
+        list_validators,
+        name_record
+    )
+
+    # writes through this model don't invalidate MODEL's cache
+    other = Model()
+    client = app.test_client()
+    rng = random.Random(args.writes)
+    failures = []
+    responses = {200: 0, 304: 0}
+    etag = None
+    try:
+        for write in range(args.writes):
+            last_name = "Name{:03d}".format(rng.randrange(20))
+            with app.app_context():
+                if rng.random() < 0.7:
+                    other.create_name(last_name, "Written{}".format(write))
+                else:
+                    try:
+                        other.delete_name(last_name)
+                    except Exception:
+                        pass
+            for _ in range(args.reads):
+                time.sleep(rng.uniform(0, args.ttl / 2))
+                headers = {"If-None-Match": etag} if etag and rng.random() < 0.5 else {}
+                response = client.get("/api/names", headers=headers)
+                responses[response.status_code] = responses.get(response.status_code, 0) + 1
+                if response.status_code != 200:
+                    continue
+
+                etag = response.headers["ETag"]
+                names = response.get_json()
+                count = int(etag.strip('"').partition("-")[0], 16)
+                if count != len(names):
+                    failures.append("ETag {} came with {} names".format(etag, len(names)))
+
+        # once the cache has expired, the list is the database's
+        time.sleep(args.ttl * 1.5)
+        with app.app_context():
+            version, rows = other.get_versioned_names()
+            expected = sorted((name_record(row) for row in rows), key=lambda name: name["lname"])
+        response = client.get("/api/names")
+        got = sorted(response.get_json(), key=lambda name: name["lname"])
+        if got != expected or response.headers["ETag"].strip('"') != list_validators(version)[0]:
+            failures.append("the list didn't catch up with the database")
+    finally:
+        MODEL.cache.clear()
+        shutil.rmtree(directory)
+
+    report = {
+        "writes": args.writes,
+        "reads": args.reads,
+        "ttl": args.ttl,
+        "responses": responses,
+        "python": sys.version.split()[0],
+        "failures": len(failures),
+        "first_failures": failures[:MAX_FAILURES]
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 1 if failures else 0
+
+
+# if we're running in stand alone mode, run the check
+if __name__ == '__main__':
+    sys.exit(main())
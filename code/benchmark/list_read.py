@@ -0,0 +1,108 @@
+"""
+This module benchmarks version 7's two ways of reading the
+list of names: loading Name objects through the ORM and calling
+each one, as NamesList.get used to, and selecting plain rows
+through SQLAlchemy Core and turning them into dictionaries with
+name_record(), as Model.get_names() does now
+
+    python list_read.py --size 100000 --repeat 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# where the version directories are
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timings(function, repeat):
+    """
+    Time repeat calls of function
+
+    :return:        list of seconds per call
+    """
+    results = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        results.append(time.perf_counter() - start)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark version 7's ORM and Core list reads")
+    parser.add_argument("--size", type=int, default=100000, help="number of names (default 100000)")
+    parser.add_argument("--repeat", type=int, default=5, help="reads timed per path (default 5)")
+    args = parser.parse_args(argv)
+
+    # point the model at a scratch database before it's imported
+    handle, database = tempfile.mkstemp(suffix=".db")
+    os.close(handle)
+    os.environ["NAMES_DATABASE_URI"] = "sqlite:///" + database
+    sys.path.insert(0, os.path.join(CODE_PATH, "version_7"))
+
+    from application import app
+    from model import (
+        Model,
+        Name,
+        db,
+        init_db,
+        name_record
+    )
+
+    try:
+        with app.app_context():
+            init_db()
+            timestamp = datetime.now()
+            rows = [
+                {"lname": "Name{:07d}".format(i), "fname": "First", "timestamp": timestamp}
+                for i in range(args.size)
+            ]
+            db.session.execute(Name.__table__.insert(), rows)
+            db.session.commit()
+            del rows
+
+            model = Model()
+
+            def orm_read():
+                names = Name.query.all()
+                records = [name() for name in names]
+                db.session.remove()
+                return records
+
+            def core_read():
+                records = [name_record(name) for name in model.get_names()]
+                db.session.remove()
+                return records
+
+            # warm up SQLite's page cache before timing either path
+            core_read()
+            results = {}
+            for path, function in (("orm", orm_read), ("core", core_read)):
+                seconds = timings(function, args.repeat)
+                results[path] = {
+                    "median_ms": round(statistics.median(seconds) * 1000, 2),
+                    "min_ms": round(min(seconds) * 1000, 2)
+                }
+    finally:
+        os.remove(database)
+
+    report = {
+        "size": args.size,
+        "repeat": args.repeat,
+        "results": results,
+        "speedup": round(results["orm"]["median_ms"] / results["core"]["median_ms"], 2)
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+# if we're running in stand alone mode, run the benchmark
+if __name__ == '__main__':
+    main()
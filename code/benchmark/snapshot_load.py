@@ -0,0 +1,101 @@
+"""
+This module measures how long version 6's store takes to come
+back after a restart from a snapshot directory, against building
+it from name dictionaries, the way the starting names are built.
+It reports:
+
+    build       NamesStore() from a dictionary of name dictionaries,
+                validating, encoding and sorting every name
+    first_open  Persistence.open() of an empty directory, the build
+                plus writing the first snapshot
+    load        Persistence.open() of the snapshot directory, with
+                a log of --writes writes to replay after it
+
+    python snapshot_load.py --size 1000000 --writes 10000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# where the version directories are
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_NAMES = ["Doug", "Kevin", "Bunny", "Ham", "Bill", "Ada", "Grace", "Alan", "Linus", "Guido"]
+
+
+def build_dicts(size):
+    timestamp = time.time()
+    return {
+        last_name: {"fname": FIRST_NAMES[i % len(FIRST_NAMES)], "lname": last_name, "timestamp": timestamp}
+        for i, last_name in enumerate("Name{:08d}".format(i) for i in range(size))
+    }
+
+
+def timed(function, *args):
+    """
+    Call function, timing it
+
+    :return:        (result, seconds)
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the restart time of version 6's names store")
+    parser.add_argument("--size", type=int, default=1000000, help="number of names (default 1000000)")
+    parser.add_argument("--writes", type=int, default=10000, help="writes logged after the snapshot (default 10000)")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.join(CODE_PATH, "version_6"))
+    from persistence import (
+        SNAPSHOT_FILE,
+        Persistence
+    )
+    from store import NamesStore
+
+    directory = tempfile.mkdtemp()
+    try:
+        records = build_dicts(args.size)
+        _, build_seconds = timed(NamesStore, records)
+
+        # the first open builds the store and saves its snapshot,
+        # then log some writes after it
+        persistence = Persistence(directory, checkpoint_writes=args.writes + 1)
+        store, first_open_seconds = timed(persistence.open, records)
+        del records
+        for i in range(args.writes):
+            store.create({"lname": "Name{:08d}".format(i * 7 % args.size), "fname": "Written"})
+        persistence.close()
+        snapshot_bytes = os.path.getsize(os.path.join(directory, SNAPSHOT_FILE))
+        del store
+
+        persistence = Persistence(directory, checkpoint_writes=args.writes + 1)
+        store, load_seconds = timed(persistence.open)
+        assert len(store) == args.size
+        persistence.close()
+    finally:
+        shutil.rmtree(directory)
+
+    report = {
+        "size": args.size,
+        "writes": args.writes,
+        "python": sys.version.split()[0],
+        "snapshot_megabytes": round(snapshot_bytes / 1024.0 / 1024.0, 1),
+        "build_seconds": round(build_seconds, 2),
+        "first_open_seconds": round(first_open_seconds, 2),
+        "load_seconds": round(load_seconds, 2)
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+# if we're running in stand alone mode, run the measurements
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+This module measures the memory version 6's store takes per
+name, against the dictionary layout versions 3 to 5 keep their
+names in. It reports three layouts:
+
+    dicts       a dictionary of name dictionaries keyed by last
+                name, with formatted timestamp strings
+    records     a dictionary of NameRecords keyed by last name,
+                the record layout of version 6's store
+    store       a whole NamesStore, the records plus their
+                encoded JSON bodies and the sorted indexes
+
+Each first name is built as a separate string, the way they
+arrive in request bodies
+
+    python store_memory.py --size 1000000
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+# where the version directories are
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_NAMES = ["Doug", "Kevin", "Bunny", "Ham", "Bill", "Ada", "Grace", "Alan", "Linus", "Guido"]
+
+
+def first_names(size):
+    # separate string objects, as if each was parsed from JSON
+    rng = random.Random(size)
+    return [(rng.choice(FIRST_NAMES) + " ")[:-1] for _ in range(size)]
+
+
+def build_dicts(size):
+    return {
+        last_name: {"fname": fname, "lname": last_name, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")}
+        for last_name, fname in zip(("Name{:07d}".format(i) for i in range(size)), first_names(size))
+    }
+
+
+def build_records(size):
+    from store import NameRecord
+    return {
+        last_name: NameRecord(last_name, fname, time.time())
+        for last_name, fname in zip(("Name{:07d}".format(i) for i in range(size)), first_names(size))
+    }
+
+
+def build_store(size):
+    from store import NamesStore
+    return NamesStore(build_dicts(size))
+
+
+def measure(build, size):
+    """
+    Measure the memory build(size) holds on to
+
+    :return:        bytes allocated
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(size)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return after - before
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the memory of version 6's names store")
+    parser.add_argument("--size", type=int, default=1000000, help="number of names (default 1000000)")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.join(CODE_PATH, "version_6"))
+
+    results = {}
+    for layout, build in (("dicts", build_dicts), ("records", build_records), ("store", build_store)):
+        allocated = measure(build, args.size)
+        results[layout] = {
+            "megabytes": round(allocated / 1024.0 / 1024.0, 1),
+            "bytes_per_name": round(allocated / float(args.size), 1)
+        }
+
+    report = {
+        "size": args.size,
+        "python": sys.version.split()[0],
+        "results": results
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+# if we're running in stand alone mode, run the measurements
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+"""
+This module hammers version 6's names resources from many threads
+at once, through the Flask test client, and checks the store
+stays consistent. It runs:
+
+    writers     threads each creating, updating and deleting names
+                of their own, and updating a few names shared by
+                all of them
+    readers     threads reading the whole list, pages of it and the
+                shared names while the writers run
+
+Every first name written is the last name followed by the writer
+and write number, so a reader can tell a torn record from a whole
+one. Afterwards each writer's own names must hold exactly its last
+write to them, each shared name the last write of one of the
+writers, and paging through the list must give the same names as
+reading it whole. The process exits with status 1 if anything
+failed.
+
+    python store_stress.py --writers 16 --readers 8 --writes 2000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+# where the version directories are
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the most failures reported
+MAX_FAILURES = 20
+
+
+def own_name(writer, number):
+    return "Stress{:03d}-{:03d}".format(writer, number)
+
+
+def shared_name(number):
+    return "Shared{:03d}".format(number)
+
+
+def is_whole(record):
+    """
+    Check a record read back is one a writer wrote, its first
+    name starts with its last name
+    """
+    return (
+        isinstance(record, dict)
+        and set(record) == {"lname", "fname", "timestamp"}
+        and record["fname"].startswith(record["lname"] + ":")
+    )
+
+
+class Stress(object):
+    """
+    This class runs the writers and readers against one application
+    and collects what went wrong
+    """
+    def __init__(self, app, args):
+        self.app = app
+        self.args = args
+        self.requests = 0
+        self.failures = []
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+
+        # each writer's expected first names, None once deleted, and
+        # the last first name each writer gave each shared name
+        self.expected = [{} for _ in range(args.writers)]
+        self.shared = [{} for _ in range(args.writers)]
+
+    def fail(self, message):
+        with self._lock:
+            self.failures.append(message)
+
+    def counted(self, requests):
+        with self._lock:
+            self.requests += requests
+
+    def check(self, response, status, what):
+        if response.status_code != status:
+            self.fail("{} returned {} rather than {}".format(what, response.status_code, status))
+            return False
+        return True
+
+    def writer(self, number):
+        client = self.app.test_client()
+        rng = random.Random(number)
+        expected = self.expected[number]
+        shared = self.shared[number]
+        for write in range(self.args.writes):
+            fname_of = "{{}}:{}:{}".format(number, write).format
+            choice = rng.random()
+            if choice < 0.2:
+                last_name = shared_name(rng.randrange(self.args.shared))
+                fname = fname_of(last_name)
+                response = client.put("/api/names/" + last_name, json={"fname": fname})
+                if self.check(response, 201, "PUT " + last_name):
+                    shared[last_name] = fname
+                continue
+
+            last_name = own_name(number, rng.randrange(self.args.names))
+            fname = fname_of(last_name)
+            if choice < 0.5:
+                response = client.post("/api/names", json={"lname": last_name, "fname": fname})
+                if self.check(response, 201, "POST " + last_name):
+                    expected[last_name] = fname
+            elif choice < 0.8:
+                response = client.put("/api/names/" + last_name, json={"fname": fname})
+                if expected.get(last_name) is None:
+                    self.check(response, 404, "PUT of deleted " + last_name)
+                elif self.check(response, 201, "PUT " + last_name):
+                    expected[last_name] = fname
+            else:
+                response = client.delete("/api/names/" + last_name)
+                if expected.get(last_name) is None:
+                    self.check(response, 404, "DELETE of deleted " + last_name)
+                elif self.check(response, 204, "DELETE " + last_name):
+                    expected[last_name] = None
+        self.counted(self.args.writes)
+
+    def reader(self, number):
+        client = self.app.test_client()
+        rng = random.Random(-1 - number)
+        requests = 0
+        while not self.stopping.is_set():
+            choice = rng.random()
+            if choice < 0.3:
+                response = client.get("/api/names")
+                requests += 1
+                if self.check(response, 200, "GET /api/names"):
+                    names = response.get_json()
+                    last_names = [record["lname"] for record in names]
+                    if len(set(last_names)) != len(last_names):
+                        self.fail("the list held a name twice")
+                    self.check_records(names, "the list")
+            elif choice < 0.6:
+                requests += self.read_pages(client)
+            else:
+                last_name = shared_name(rng.randrange(self.args.shared))
+                response = client.get("/api/names/" + last_name)
+                requests += 1
+                if self.check(response, 200, "GET " + last_name):
+                    self.check_records([response.get_json()], last_name)
+        self.counted(requests)
+
+    def read_pages(self, client, limit=50):
+        """
+        Page through the list, the last names must only go up
+
+        :return:        the number of requests made
+        """
+        requests = 0
+        cursor = None
+        previous = ""
+        while True:
+            url = "/api/names?limit={}".format(limit) + ("&cursor=" + cursor if cursor else "")
+            response = client.get(url)
+            requests += 1
+            if not self.check(response, 200, "GET " + url):
+                return requests
+            page = response.get_json()
+            for record in page["names"]:
+                if record["lname"] <= previous:
+                    self.fail("page of {} went back from {} to {}".format(url, previous, record["lname"]))
+                previous = record["lname"]
+            self.check_records(page["names"], "a page")
+            cursor = page["next"]
+            if cursor is None:
+                return requests
+
+    def check_records(self, records, where):
+        for record in records:
+            if record["lname"].startswith(("Stress", "Shared")) and not is_whole(record):
+                self.fail("{} held a torn record {!r}".format(where, record))
+
+    def run(self):
+        # the shared names exist before the writers start
+        client = self.app.test_client()
+        for number in range(self.args.shared):
+            last_name = shared_name(number)
+            client.post("/api/names", json={"lname": last_name, "fname": last_name + ":seed"})
+
+        writers = [
+            threading.Thread(target=self.writer, args=(number,))
+            for number in range(self.args.writers)
+        ]
+        readers = [
+            threading.Thread(target=self.reader, args=(number,))
+            for number in range(self.args.readers)
+        ]
+        start = time.perf_counter()
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        self.stopping.set()
+        for thread in readers:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        self.check_final(client)
+        return seconds
+
+    def check_final(self, client):
+        """
+        Check the store holds every writer's last write
+        """
+        names = {record["lname"]: record["fname"] for record in client.get("/api/names").get_json()}
+
+        for expected in self.expected:
+            for last_name, fname in expected.items():
+                if names.get(last_name) != fname:
+                    self.fail("{} ended as {!r} rather than {!r}".format(last_name, names.get(last_name), fname))
+
+        for number in range(self.args.shared):
+            last_name = shared_name(number)
+            written = {shared[last_name] for shared in self.shared if last_name in shared}
+            if written and names.get(last_name) not in written:
+                self.fail("{} ended as {!r}, which no writer wrote last".format(last_name, names.get(last_name)))
+
+        # paging must give the same names as the whole list
+        paged = {}
+        cursor = None
+        while True:
+            page = client.get("/api/names?limit=100" + ("&cursor=" + cursor if cursor else "")).get_json()
+            paged.update((record["lname"], record["fname"]) for record in page["names"])
+            cursor = page["next"]
+            if cursor is None:
+                break
+        if paged != names:
+            self.fail("paging gave {} names, the list {}".format(len(paged), len(names)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stress version 6's names resources from many threads")
+    parser.add_argument("--writers", type=int, default=16, help="writer threads (default 16)")
+    parser.add_argument("--readers", type=int, default=8, help="reader threads (default 8)")
+    parser.add_argument("--writes", type=int, default=2000, help="writes per writer (default 2000)")
+    parser.add_argument("--names", type=int, default=20, help="names each writer owns (default 20)")
+    parser.add_argument("--shared", type=int, default=5, help="names all the writers update (default 5)")
+    parser.add_argument("--switch-interval", type=float, default=1e-5,
+                        help="seconds between thread switches, small to interleave the threads more")
+    args = parser.parse_args(argv)
+
+    # an in-memory store, never a snapshot directory
+    os.environ.pop("NAMES_SNAPSHOT_DIR", None)
+    sys.path.insert(0, os.path.join(CODE_PATH, "version_6"))
+    from presentation import app
+
+    sys.setswitchinterval(args.switch_interval)
+    stress = Stress(app, args)
+    seconds = stress.run()
+
+    report = {
+        "writers": args.writers,
+        "readers": args.readers,
+        "requests": stress.requests,
+        "seconds": round(seconds, 2),
+        "requests_per_second": round(stress.requests / seconds),
+        "python": sys.version.split()[0],
+        "failures": len(stress.failures),
+        "first_failures": stress.failures[:MAX_FAILURES]
+    }
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+    return 1 if stress.failures else 0
+
+
+# if we're running in stand alone mode, run the stress test
+if __name__ == '__main__':
+    sys.exit(main())
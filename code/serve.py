@@ -0,0 +1,143 @@
+"""
+This module runs one of the presentation versions under
+gunicorn, a pre-fork multi-process server, rather than the
+single process development server app.run(debug=True) starts.
+
+The application is imported once in the master process before
+the workers are forked, so they share the import cost, and the
+debugger and reloader are off. Sending the master a HUP signal
+gracefully restarts the workers.
+
+The in-memory versions (3 to 6) keep their names in the worker
+process, so they're served by one worker, scaled with --threads,
+which imports the application itself. Importing it in the master
+would leave every new worker starting from the names as they were
+at start up, and a persistent version 6 would open its snapshot
+directory in the master rather than in the worker writing to it.
+
+    python serve.py version_7 --workers 4 --threads 8
+    python serve.py version_7 --app asgi:application --worker-class uvicorn.workers.UvicornWorker
+"""
+
+import argparse
+import functools
+import importlib
+import multiprocessing
+import os
+import sys
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    sys.exit("serve.py needs gunicorn, install it with: pip install gunicorn")
+
+
+# the versions keeping their names in the worker process
+IN_MEMORY_VERSIONS = ("version_3", "version_4", "version_5", "version_6")
+
+
+def post_fork(server, worker):
+    """
+    Give each worker its own database connections, a forked
+    process mustn't reuse the sockets or files of its parent
+    """
+    model = sys.modules.get("model")
+    if model is not None and hasattr(model, "db"):
+        with model.app.app_context():
+            model.db.engine.dispose()
+
+
+class PresentationServer(BaseApplication):
+    """
+    This class runs an application under gunicorn, loaded in the
+    master when the options preload it, otherwise in the worker
+    """
+    def __init__(self, loader, options):
+        """
+        :param loader:      function importing the application
+        """
+        self.loader = loader
+        self.options = options
+        super(PresentationServer, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.loader()
+
+
+def load_application(version, app_path):
+    """
+    Import the application from a version directory
+
+    :param version:     the version directory, e.g. version_7
+    :param app_path:    module:attribute of the application
+    """
+    version_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), version)
+    if not os.path.isdir(version_path):
+        sys.exit("no such version: {}".format(version))
+
+    # the versions import their sibling modules by name
+    sys.path.insert(0, version_path)
+    module_name, _, attribute = app_path.partition(":")
+    application = getattr(importlib.import_module(module_name), attribute or "app")
+
+    # never serve the debugger
+    if hasattr(application, "debug"):
+        application.debug = False
+    return application
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a presentation version under gunicorn")
+    parser.add_argument("version", help="the version directory to serve, e.g. version_7")
+    parser.add_argument("--app", default="presentation:app",
+                        help="module:attribute of the application (default presentation:app)")
+    parser.add_argument("--bind", default="127.0.0.1:5000")
+    parser.add_argument("--workers", type=int,
+                        help="number of worker processes (default 2 x cores + 1, "
+                             "versions 3 to 6 only run with 1)")
+    parser.add_argument("--threads", type=int, default=4,
+                        help="number of threads per worker (default 4)")
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--timeout", type=int, default=30)
+    parser.add_argument("--graceful-timeout", type=int, default=30,
+                        help="seconds workers get to finish requests on restart")
+    parser.add_argument("--max-requests", type=int, default=0,
+                        help="recycle a worker after this many requests, 0 never does")
+    args = parser.parse_args(argv)
+
+    in_memory = args.version in IN_MEMORY_VERSIONS
+    if in_memory:
+        if args.workers not in (None, 1):
+            sys.exit("{} keeps its names in the worker process, serve it with --workers 1".format(args.version))
+        workers = 1
+    else:
+        workers = args.workers or multiprocessing.cpu_count() * 2 + 1
+
+    options = {
+        "bind": args.bind,
+        "workers": workers,
+        "threads": args.threads,
+        "worker_class": args.worker_class,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": args.max_requests // 10,
+        "preload_app": not in_memory,
+        "post_fork": post_fork
+    }
+    # give version 7's model a database connection per thread, and
+    # with more than one worker turn off its cache, a worker would
+    # otherwise serve the list from before another worker's write
+    os.environ.setdefault("NAMES_DB_POOL_SIZE", str(args.threads))
+    if workers > 1:
+        os.environ.setdefault("NAMES_CACHE_TTL", "0")
+    PresentationServer(functools.partial(load_application, args.version, args.app), options).run()
+
+
+# if we're running in stand alone mode, run the server
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+This module encodes the JSON responses with the fastest encoder
+installed, orjson, then ujson, falling back to the standard
+library's json. It plugs that encoder into flask_restful, as the
+application/json representation, and into Flask, as its JSON
+provider, so jsonify() uses it too. The output is compact, it's
+only pretty printed when the application is in debug mode
+"""
+
+import json
+
+from flask import (
+    current_app,
+    make_response
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    # Flask 2.2 and later encode through a JSON provider
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:
+    DefaultJSONProvider = None
+
+
+def stdlib_dumps(data, default=None):
+    return json.dumps(data, default=default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+if orjson is not None:
+    ENCODER = "orjson"
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def fast_dumps(data, default=None):
+        return orjson.dumps(data, default=default, option=ORJSON_OPTIONS)
+
+elif ujson is not None:
+    ENCODER = "ujson"
+
+    def fast_dumps(data, default=None):
+        kwargs = {"default": default} if default is not None else {}
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, **kwargs).encode("utf-8")
+
+else:
+    ENCODER = "json"
+    fast_dumps = stdlib_dumps
+
+
+def dumps(data, default=None):
+    """
+    Encode data as compact JSON bytes
+
+    :param default:     function turning an object the encoder
+                        doesn't know into one it does
+    """
+    try:
+        return fast_dumps(data, default=default)
+    except (TypeError, OverflowError):
+        # the fast encoders are stricter than json, about big
+        # integers for example, so let json have a go
+        return stdlib_dumps(data, default=default)
+
+
+def output_json(data, code, headers=None):
+    """
+    Make a flask_restful response with a JSON encoded body, this
+    replaces flask_restful.representations.json.output_json
+    """
+    # the RESTFUL_JSON settings and debug mode's pretty printing
+    # are json.dumps() options, so they use json
+    settings = current_app.config.get("RESTFUL_JSON")
+    if settings or current_app.debug:
+        settings = dict(settings or {})
+        if current_app.debug:
+            settings.setdefault("indent", 4)
+        body = json.dumps(data, **settings).encode("utf-8")
+    else:
+        body = dumps(data)
+
+    # always end the json with a new line
+    resp = make_response(body + b"\n", code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+if DefaultJSONProvider is not None:
+    class FastJSONProvider(DefaultJSONProvider):
+        """
+        This class makes Flask's jsonify() use the fast encoder,
+        objects it doesn't know, like dates, are still converted
+        the way Flask does
+        """
+        def dumps(self, obj, **kwargs):
+            if kwargs:
+                return super(FastJSONProvider, self).dumps(obj, **kwargs)
+            return dumps(obj, default=self.default).decode("utf-8")
+
+        def response(self, *args, **kwargs):
+            if self._app.debug or self.compact is False:
+                return super(FastJSONProvider, self).response(*args, **kwargs)
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(dumps(obj, default=self.default) + b"\n", mimetype=self.mimetype)
+
+
+def init_app(app):
+    """
+    Make app's jsonify() use the fast encoder, on Flask versions
+    with JSON providers
+    """
+    if DefaultJSONProvider is not None:
+        app.json = FastJSONProvider(app)
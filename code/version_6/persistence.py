@@ -0,0 +1,378 @@
+"""
+This module keeps the names of the store in store.py across
+restarts. The store is saved as a snapshot file, and every write
+made after the snapshot is appended to a mutation log, so a
+restarted server loads the snapshot and replays the short log
+rather than having every name sent through the API again.
+
+The snapshot is columnar: the last names, first names, timestamps
+and encoded JSON bodies of all the names in last name order, and
+the first name index, dumped with marshal. Loading it runs no JSON
+encoding and no sorting, it only builds the entries.
+
+The logs are numbered, and the snapshot records the last log it
+covers. A checkpoint starts the next log, writes a snapshot of
+the store as it was at that moment to a temporary file, renames
+it over the old snapshot, which is atomic, and then deletes the
+logs the new snapshot covers. Wherever the server stops, the
+directory holds a snapshot and the logs written since it.
+
+The directory is locked to the process that opened it, the names
+live in that process, so serve a persistent version 6 with one
+worker, and open it in that worker, not in a process it's forked
+from. A worker replacing one that's still shutting down waits for
+the lock, then loads the writes the old one made
+"""
+
+import array
+import gc
+import json
+import logging
+import marshal
+import os
+import threading
+import time
+from itertools import repeat
+
+from encoding import dumps
+from store import (
+    Entry,
+    NameRecord,
+    NamesStore
+)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# the files in a snapshot directory
+SNAPSHOT_FILE = "names.snapshot"
+LOG_PREFIX = "names."
+LOG_SUFFIX = ".log"
+LOCK_FILE = "names.lock"
+
+# bumped whenever the layout of the snapshot changes
+SNAPSHOT_FORMAT = 1
+
+logger = logging.getLogger(__name__)
+
+
+def log_name(sequence):
+    """
+    Get the file name of log number sequence, zero padded so the
+    logs sort in order
+    """
+    return "{}{:010d}{}".format(LOG_PREFIX, sequence, LOG_SUFFIX)
+
+
+def sync_directory(directory):
+    """
+    Sync a directory, so a file renamed into it survives a crash
+    """
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        # some platforms can't open a directory
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(path, sequence, entries, last_names, first_names):
+    """
+    Write a snapshot of the store to path, replacing any snapshot
+    that's already there in one atomic rename
+
+    :param sequence:    the number of the last log the snapshot covers
+    :param entries:     dictionary of Entries keyed by last name
+    :param last_names:  the sorted last names
+    :param first_names: the sorted (first name, last name) pairs
+    """
+    records = [entries[last_name].record for last_name in last_names]
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "sequence": sequence,
+        "last_names": last_names,
+        # the few records whose lname isn't the name they're kept under
+        "renamed": {
+            last_name: record.lname
+            for last_name, record in zip(last_names, records)
+            if record.lname != last_name
+        },
+        "fnames": [record.fname for record in records],
+        "timestamps": array.array("d", [record.timestamp for record in records]).tobytes(),
+        "bodies": [entries[last_name].body for last_name in last_names],
+        # the strings here are the same objects as the ones above,
+        # so marshal writes them as references
+        "index_fnames": [fname for fname, last_name in first_names],
+        "index_last_names": [last_name for fname, last_name in first_names]
+    }
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as snapshot_file:
+        marshal.dump(snapshot, snapshot_file)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary, path)
+    sync_directory(os.path.dirname(path))
+
+
+def read_snapshot(path):
+    """
+    Load the store a snapshot holds
+
+    :return:            (the number of the last log it covers, NamesStore)
+    :raises ValueError: if the file isn't a snapshot this module wrote
+    """
+    # reading the whole file and then decoding it is several times
+    # faster than marshal.load() reading it a bit at a time
+    with open(path, "rb") as snapshot_file:
+        snapshot = marshal.loads(snapshot_file.read())
+    if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError("{} isn't a names snapshot".format(path))
+
+    timestamps = array.array("d")
+    timestamps.frombytes(snapshot["timestamps"])
+    renamed = snapshot["renamed"]
+    last_names = snapshot["last_names"]
+
+    # the objects built here all live as long as the store, so
+    # don't let the garbage collector scan them while they're being
+    # built, and afterwards move them out of its way for good
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        lnames = [renamed.get(last_name, last_name) for last_name in last_names] if renamed else last_names
+        records = list(map(NameRecord, lnames, snapshot["fnames"], timestamps))
+        entries = dict(zip(last_names, map(Entry, records, snapshot["bodies"], repeat(0))))
+        first_names = list(zip(snapshot["index_fnames"], snapshot["index_last_names"]))
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+    finally:
+        if collecting:
+            gc.enable()
+    return snapshot["sequence"], NamesStore.from_entries(entries, last_names, first_names)
+
+
+def read_log(path):
+    """
+    Generate the writes in a log, [last name, lname, fname, timestamp]
+    for a stored record and [last name] for a delete
+    """
+    with open(path, "rb") as log_file:
+        for line in log_file:
+            if not line.endswith(b"\n"):
+                # the server stopped part way through this write,
+                # which never made it into the store
+                logger.warning("ignoring the incomplete last write in %s", path)
+                return
+            yield json.loads(line)
+
+
+def replay_logs(store, paths):
+    """
+    Apply the writes in logs to store, in order
+    """
+    writes = []
+    for path in paths:
+        for write in read_log(path):
+            if len(write) == 1:
+                writes.append((write[0], None))
+            else:
+                last_name, lname, fname, timestamp = write
+                writes.append((last_name, NameRecord(lname, fname, timestamp)))
+    if writes:
+        store.restore(writes)
+
+
+class MutationLog(object):
+    """
+    This class appends writes to a log file, one JSON array per
+    line. The file is unbuffered, so a write is in the operating
+    system's hands by the time the store has it, and survives the
+    server process dying. Syncing each write as well makes it
+    survive the machine going down, at the cost of a disk flush
+    per write
+    """
+    def __init__(self, path, sequence, fsync=False):
+        """
+        :param sequence:    the log's number
+        :param fsync:       sync the file after every write
+        """
+        self.path = path
+        self.sequence = sequence
+        self.fsync = fsync
+        self.writes = 0
+        self._file = open(path, "ab", buffering=0)
+
+    def append(self, write):
+        self._file.write(dumps(write) + b"\n")
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.writes += 1
+
+    def close(self):
+        self._file.close()
+
+
+class Persistence(object):
+    """
+    This class loads a NamesStore from a snapshot directory and
+    keeps it there. It's the store's journal, the store calls
+    record_store() and record_delete() under its lock for every
+    write, and after checkpoint_writes writes to a log a checkpoint
+    runs in a background thread
+    """
+    def __init__(self, directory, checkpoint_writes=100000, fsync=False, lock_timeout=0):
+        """
+        :param directory:           where the snapshot and logs go
+        :param checkpoint_writes:   writes logged before a checkpoint
+        :param fsync:               sync the log after every write
+        :param lock_timeout:        seconds to wait for another process
+                                    to let go of the directory
+        """
+        self.directory = os.path.abspath(directory)
+        self.checkpoint_writes = checkpoint_writes
+        self.fsync = fsync
+        self.lock_timeout = lock_timeout
+        self.store = None
+        self._log = None
+        self._lock_file = None
+        self._checkpointing = threading.Lock()
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, SNAPSHOT_FILE)
+
+    def log_paths(self):
+        """
+        Get the (number, path) of the logs in the directory, in order
+        """
+        logs = []
+        for filename in os.listdir(self.directory):
+            number = filename[len(LOG_PREFIX):-len(LOG_SUFFIX)]
+            if filename.startswith(LOG_PREFIX) and filename.endswith(LOG_SUFFIX) and number.isdigit():
+                logs.append((int(number), os.path.join(self.directory, filename)))
+        return sorted(logs)
+
+    def _lock_directory(self):
+        if fcntl is None:
+            return
+        self._lock_file = open(os.path.join(self.directory, LOCK_FILE), "a")
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    self._lock_file.close()
+                    self._lock_file = None
+                    raise RuntimeError("{} is in use by another process".format(self.directory))
+            time.sleep(0.1)
+
+    def open(self, records=None):
+        """
+        Load the store from the directory, the snapshot and then the
+        logs after it, and start logging its writes
+
+        :param records:     dictionary of name record dictionaries to
+                            start the store with when the directory
+                            has no snapshot yet
+        :return:            the NamesStore
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_directory()
+
+        has_snapshot = os.path.exists(self.snapshot_path)
+        if has_snapshot:
+            sequence, store = read_snapshot(self.snapshot_path)
+        else:
+            sequence, store = 0, NamesStore(records)
+
+        logs = [(number, path) for number, path in self.log_paths() if number > sequence]
+        replay_logs(store, [path for number, path in logs])
+        if logs:
+            sequence = logs[-1][0]
+
+        # always start a new log, the last one may end part way
+        # through a write
+        self.store = store
+        self._log = MutationLog(os.path.join(self.directory, log_name(sequence + 1)), sequence + 1, self.fsync)
+        store.journal = self
+
+        # save the starting names straight away, and fold the logs
+        # just replayed into a new snapshot in the background
+        if not has_snapshot:
+            self.checkpoint()
+        elif logs:
+            self._checkpoint_soon()
+        return store
+
+    def record_store(self, last_name, record):
+        self._logged([last_name, record.lname, record.fname, record.timestamp])
+
+    def record_delete(self, last_name):
+        self._logged([last_name])
+
+    def _logged(self, write):
+        # called holding the store's lock
+        self._log.append(write)
+        if self._log.writes >= self.checkpoint_writes:
+            self._checkpoint_soon()
+
+    def _checkpoint_soon(self):
+        # start a checkpoint in the background, unless one is running
+        if self._checkpointing.acquire(blocking=False):
+            thread = threading.Thread(target=self._checkpoint_thread, name="names-checkpoint")
+            thread.daemon = True
+            thread.start()
+
+    def _checkpoint_thread(self):
+        try:
+            self._checkpoint()
+        except Exception:
+            logger.exception("checkpoint of %s failed", self.directory)
+        finally:
+            self._checkpointing.release()
+
+    def checkpoint(self):
+        """
+        Snapshot the store and delete the logs the snapshot covers
+        """
+        with self._checkpointing:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        covered = self._log
+
+        def next_log():
+            # the writes from here on go to the next log
+            sequence = covered.sequence + 1
+            path = os.path.join(self.directory, log_name(sequence))
+            self._log = MutationLog(path, sequence, self.fsync)
+
+        entries, last_names, first_names = self.store.snapshot(during=next_log)
+        covered.close()
+        write_snapshot(self.snapshot_path, covered.sequence, entries, last_names, first_names)
+        for number, path in self.log_paths():
+            if number <= covered.sequence:
+                os.remove(path)
+
+    def close(self):
+        """
+        Stop logging the store's writes and unlock the directory,
+        once any checkpoint that's running has finished
+        """
+        with self._checkpointing:
+            if self.store is not None:
+                self.store.journal = None
+            if self._log is not None:
+                self._log.close()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
@@ -1,28 +1,51 @@
-# import python module to create timestamp
-from datetime import datetime
+# import modules to page through and stream the names
+import base64
+import binascii
+import calendar
+import os
+from itertools import islice
 
 # import Flask, the Python micro web framework
 from flask import (
     Flask,
+    Response,
+    make_response,
     render_template,
-    request
+    request,
+    stream_with_context
  )
 
 # import the Flask API package
 from flask_restful import (
     Resource,
     Api,
-    abort
+    abort,
+    inputs,
+    reqparse
 )
 from flask_restful_swagger import swagger
+from werkzeug.http import (
+    http_date,
+    quote_etag
+)
 
-
-def get_timestamp():
-    return datetime.now().strftime(("%Y-%m-%d %H:%M:%S"))
+# import the fast JSON encoder, the response compression, the
+# names data structure and its snapshots
+import compression
+import encoding
+from encoding import (
+    dumps,
+    output_json
+)
+from persistence import Persistence
+from store import (
+    NamesStore,
+    get_timestamp
+)
 
 
 # data to serve with our API
-LIST_OF_NAMES = {
+STARTING_NAMES = {
     "Farrell": {"fname": "Doug", "lname": "Farrell", "timestamp" :get_timestamp()},
     "Murphy": {"fname": "Kevin", "lname": "Murphy", "timestamp": get_timestamp()},
     "Easter": {"fname": "Bunny", "lname": "Easter", "timestamp": get_timestamp()},
@@ -30,6 +53,177 @@ LIST_OF_NAMES = {
     "Nye": {"fname": "Bill", "lname": "Nye", "timestamp": get_timestamp()}
 }
 
+# keep the names across restarts when NAMES_SNAPSHOT_DIR is set,
+# the starting names are only used the first time
+if os.environ.get("NAMES_SNAPSHOT_DIR"):
+    PERSISTENCE = Persistence(
+        os.environ["NAMES_SNAPSHOT_DIR"],
+        checkpoint_writes=int(os.environ.get("NAMES_SNAPSHOT_WRITES", 100000)),
+        fsync=os.environ.get("NAMES_SNAPSHOT_FSYNC", "0") == "1",
+        # a restarted worker waits for the one it replaces to exit
+        lock_timeout=float(os.environ.get("NAMES_SNAPSHOT_LOCK_TIMEOUT", 30))
+    )
+    LIST_OF_NAMES = PERSISTENCE.open(STARTING_NAMES)
+else:
+    PERSISTENCE = None
+    LIST_OF_NAMES = NamesStore(STARTING_NAMES)
+
+
+def json_response(body, status=200, headers=None):
+    """
+    Build a response around an already encoded JSON body
+    """
+    return Response(body, status=status, headers=headers, mimetype="application/json")
+
+
+def validator_headers(etag, last_modified):
+    """
+    Build the ETag and Last-Modified headers for a response
+
+    :param etag:            the unquoted etag
+    :param last_modified:   seconds since the epoch, or None
+    """
+    headers = {"ETag": quote_etag(etag)}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified(etag, last_modified):
+    """
+    Check the request's If-None-Match and If-Modified-Since headers
+    against the current etag and modification time, so a client
+    that is up to date gets a 304 before any payload is built
+
+    :return:        a 304 Not Modified response, or None if the
+                    client needs the payload
+    """
+    # If-None-Match uses the weak comparison, compressed responses
+    # carry a weak version of the etag
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None and last_modified is not None:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        matched = int(last_modified) <= since
+    else:
+        matched = False
+
+    if not matched:
+        return None
+    rsp = make_response("", 304)
+    rsp.headers.extend(validator_headers(etag, last_modified))
+    return rsp
+
+
+# page sizes used when paging through the names list
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# parser for the paging arguments of the names list
+PAGE_PARSER = reqparse.RequestParser()
+PAGE_PARSER.add_argument("limit", type=int, location="args")
+PAGE_PARSER.add_argument("cursor", type=str, location="args")
+
+# parser for the search arguments of the names list
+SEARCH_PARSER = reqparse.RequestParser()
+SEARCH_PARSER.add_argument("fname", type=str, location="args")
+SEARCH_PARSER.add_argument("lname", type=str, location="args")
+SEARCH_PARSER.add_argument("prefix", type=inputs.boolean, location="args", default=False)
+
+
+def encode_cursor(last_name):
+    """
+    Turn the last name a page ended on into an opaque cursor
+    """
+    return base64.urlsafe_b64encode(last_name.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Turn an opaque cursor back into the last name a page ended on
+    """
+    try:
+        last_name = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(400, message="Invalid cursor")
+
+    # urlsafe_b64decode() silently drops characters outside the
+    # alphabet, so only accept a cursor encode_cursor() could make
+    if encode_cursor(last_name) != cursor:
+        abort(400, message="Invalid cursor")
+    return last_name
+
+
+def get_page_arguments():
+    """
+    Get the paging arguments from the request
+
+    :return:        (limit, last name to start after), or (None, None)
+                    when the request didn't ask for a page
+    """
+    args = PAGE_PARSER.parse_args()
+    if args.limit is None and args.cursor is None:
+        return None, None
+
+    limit = args.limit if args.limit is not None else DEFAULT_PAGE_SIZE
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400, message="limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    after = decode_cursor(args.cursor) if args.cursor else None
+    return limit, after
+
+
+def get_search_arguments():
+    """
+    Get the search arguments from the request
+
+    :return:        the parsed arguments, or None when the request
+                    isn't a search
+    """
+    args = SEARCH_PARSER.parse_args()
+    if args.fname is None and args.lname is None:
+        return None
+    if "cursor" in request.args:
+        abort(400, message="A search can't be paged with a cursor")
+    return args
+
+
+# number of names encoded into each chunk of a streamed export
+EXPORT_CHUNK_SIZE = 1000
+
+
+def chunk_records(records):
+    """
+    Generate lists of at most EXPORT_CHUNK_SIZE records
+    """
+    records = iter(records)
+    chunk = list(islice(records, EXPORT_CHUNK_SIZE))
+    while chunk:
+        yield chunk
+        chunk = list(islice(records, EXPORT_CHUNK_SIZE))
+
+
+def stream_names(bodies, ndjson=False):
+    """
+    Generate the names as a JSON array, or as newline delimited
+    JSON, a chunk of records at a time so the whole document is
+    never built in memory
+
+    :param bodies:      iterable of encoded name records
+    :param ndjson:      generate one JSON document per line
+    """
+    if ndjson:
+        for chunk in chunk_records(bodies):
+            yield b"\n".join(chunk) + b"\n"
+        return
+
+    yield b"["
+    separator = b""
+    for chunk in chunk_records(bodies):
+        yield separator + b",".join(chunk)
+        separator = b","
+    yield b"]"
+
 
 class Names(Resource):
     """
@@ -54,21 +248,31 @@ class Names(Resource):
             {
                 'code': 200,
                 'message': 'Retrieved the requested name'
+            },
+            {
+                'code': 304,
+                'message': 'The name has not changed since the If-None-Match etag or If-Modified-Since time'
+            },
+            {
+                'code': 404,
+                'message': 'Not found'
             }
         ]
     )
     def get(self, last_name):
         """Get a particular name record"""
-        # did we get an endpoint parameter?
-        if last_name is not None:
-            if last_name in self.names:
-                retval = self.names.get(last_name)
+        # nope, didn't find the resource
+        entry = self.names.get(last_name)
+        if entry is None:
+            abort(404)
 
-        # otherwise, nope, didn't find the resource
-        else:
-            abort(404, )
+        # does the client already have this version of the record?
+        etag = self.names.etag(entry.version)
+        rsp = not_modified(etag, entry.last_modified)
+        if rsp is not None:
+            return rsp
 
-        return retval
+        return json_response(entry.body, headers=validator_headers(etag, entry.last_modified))
 
     @swagger.operation(
         notes='update a name in the data structure',
@@ -84,7 +288,7 @@ class Names(Resource):
             },
             {
                 'name': 'body',
-                'description': 'A name record to update',
+                'description': 'A name record to update, an lname must match the last name updated',
                 'required': True,
                 'type': 'name',
                 'paramType': 'body'
@@ -94,29 +298,30 @@ class Names(Resource):
             {
                 'code': 204,
                 'message': 'Name record updated'
+            },
+            {
+                'code': 400,
+                'message': 'Invalid input'
             }
         ]
     )
     def put(self, last_name):
         """Update a name record"""
-        record = None
+        # get the PUT JSON data
+        put_data = request.get_json()
 
         # did we get a valid name?
-        if last_name in self.names:
-            # get the PUT JSON data
-            put_data = request.get_json()
-
-            record = self.names.get(last_name)
-            record["lname"] = put_data.get("lname", record["lname"])
-            record["fname"] = put_data.get("fname", record["fname"])
-            record["timestamp"] = get_timestamp()
+        try:
+            entry = self.names.update(last_name, put_data)
+        except ValueError as e:
+            abort(400, message=str(e))
 
         # otherwise, nope, didn't find the record
-        else:
+        if entry is None:
             abort(404)
 
         # return the updated record
-        return record, 201
+        return json_response(entry.body, status=201)
 
     @swagger.operation(
         notes='delete a name from the data structure',
@@ -145,12 +350,8 @@ class Names(Resource):
         """
         Deletes a record from the names structure
         """
-        # did we get a valid name?
-        if last_name in self.names:
-            del self.names[last_name]
-
-        # otherwise, nope, didn't find the record
-        else:
+        # did we get a valid name? otherwise, nope, didn't find the record
+        if not self.names.delete(last_name):
             abort(404)
 
         return "", 204
@@ -166,18 +367,97 @@ class NamesList(Resource):
     @swagger.operation(
         notes='This method gets the list of all names from the data structure',
         nickname='Read',
+        parameters=[
+            {
+                'name': 'limit',
+                'description': 'The maximum number of names to return in a page',
+                'required': False,
+                'dataType': 'integer',
+                'paramType': 'query'
+            },
+            {
+                'name': 'cursor',
+                'description': 'The next cursor returned by the previous page',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            },
+            {
+                'name': 'fname',
+                'description': 'Search for names with this first name',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            },
+            {
+                'name': 'lname',
+                'description': 'Search for names with this last name',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            },
+            {
+                'name': 'prefix',
+                'description': 'Search for names starting with fname and lname',
+                'required': False,
+                'dataType': 'boolean',
+                'paramType': 'query'
+            }
+        ],
         responseMessages=[
             {
                 'code': 200,
                 'message': 'Retrieved the entire names list'
+            },
+            {
+                'code': 304,
+                'message': 'The list has not changed since the If-None-Match etag or If-Modified-Since time'
+            },
+            {
+                'code': 400,
+                'message': 'Invalid limit or cursor'
             }
         ]
     )
     def get(self):
         """
-        Get the entire list of names
+        Get the entire list of names, a page of it ordered by
+        last name when a limit or cursor is passed, or the names
+        matching a search by fname and/or lname
         """
-        return [record for record in self.names.values()]
+        limit, after = get_page_arguments()
+        search = get_search_arguments()
+
+        # does the client already have this version of the list?
+        etag = self.names.etag(self.names.version)
+        last_modified = self.names.last_modified
+        rsp = not_modified(etag, last_modified)
+        if rsp is not None:
+            return rsp
+
+        headers = validator_headers(etag, last_modified)
+        if search is not None:
+            entries = self.names.search(fname=search.fname,
+                                        lname=search.lname,
+                                        prefix=search.prefix,
+                                        limit=limit or MAX_PAGE_SIZE)
+            body = b"[" + b",".join(entry.body for entry in entries) + b"]"
+            return json_response(body, headers=headers)
+
+        if limit is None:
+            return json_response(self.names.list_body(), headers=headers)
+
+        # get one extra name, it tells us if there is another page
+        page = self.names.page(after=after, limit=limit + 1)
+        next_cursor = encode_cursor(page[limit - 1][0]) if len(page) > limit else None
+        body = b"".join([
+            b'{"names":[',
+            b",".join(entry.body for last_name, entry in page[:limit]),
+            b'],"next":',
+            dumps(next_cursor),
+            b"}"
+        ])
+        return json_response(body, headers=headers)
 
     @swagger.operation(
         notes='create a new name in the data structure',
@@ -197,6 +477,10 @@ class NamesList(Resource):
                 'code': 201,
                 'message': 'Created the new name record',
             },
+            {
+                'code': 400,
+                'message': 'Invalid input'
+            },
             {
                 'code': 405,
                 'message': 'Invalid input'
@@ -210,14 +494,124 @@ class NamesList(Resource):
         # get the POST JSON data
         post_data = request.get_json()
 
-        # update the post_data with current timestamp
-        post_data["timestamp"] = get_timestamp()
-
-        # update the list of names
-        self.names[post_data["lname"]] = post_data
+        # update the list of names, the store timestamps the record
+        try:
+            entry = self.names.create(post_data)
+        except ValueError as e:
+            abort(400, message=str(e))
 
         # return the newly created record
-        return post_data, 201
+        return json_response(entry.body, status=201)
+
+
+class NamesExport(Resource):
+    """
+    Our NameExport API
+    """
+    def __init__(self):
+        self.names = LIST_OF_NAMES
+
+    @swagger.operation(
+        notes='This method streams the list of all names from the data structure',
+        nickname='Export',
+        parameters=[
+            {
+                'name': 'format',
+                'description': 'json for a JSON array (the default) or ndjson for one name per line',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            }
+        ],
+        responseMessages=[
+            {
+                'code': 200,
+                'message': 'Streamed the entire names list'
+            },
+            {
+                'code': 400,
+                'message': 'Invalid format'
+            }
+        ]
+    )
+    def get(self):
+        """
+        Stream the entire list of names
+        """
+        export_format = request.args.get("format", "json")
+        if export_format not in ("json", "ndjson"):
+            abort(400, message="format must be json or ndjson")
+
+        # take a snapshot of the entries so the store can
+        # change while the response is streaming
+        bodies = (entry.body for entry in self.names.entries())
+        ndjson = export_format == "ndjson"
+        return Response(
+            stream_with_context(stream_names(bodies, ndjson=ndjson)),
+            mimetype="application/x-ndjson" if ndjson else "application/json"
+        )
+
+
+class NamesChanges(Resource):
+    """
+    Our NamesChanges API
+    """
+    def __init__(self):
+        self.names = LIST_OF_NAMES
+
+    @swagger.operation(
+        notes='This method gets the names written since a version of the list, so a client can keep its copy '
+              'of the list up to date without fetching all of it. Without since it returns all the names',
+        nickname='Changes',
+        parameters=[
+            {
+                'name': 'since',
+                'description': 'The version returned by the previous call',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            }
+        ],
+        responseMessages=[
+            {
+                'code': 200,
+                'message': 'The version of the list, the names created or updated and the last names deleted'
+            },
+            {
+                'code': 410,
+                'message': 'The changes since that version are gone, fetch them all without since'
+            }
+        ]
+    )
+    def get(self):
+        """
+        Get the changes to the names since a version of the list
+        """
+        since = request.args.get("since")
+
+        # without a version, the client has nothing yet
+        if since is None:
+            version = self.names.version
+            names, deleted = self.names.list_body(), []
+        else:
+            since_version = self.names.version_of(since)
+            changes = self.names.changes(since_version) if since_version is not None else None
+            if changes is None:
+                abort(410, message="The changes since {} are gone, fetch all the names".format(since))
+            version, changes = changes
+            names = b"[" + b",".join(body for last_name, body in changes if body is not None) + b"]"
+            deleted = [last_name for last_name, body in changes if body is None]
+
+        body = b"".join([
+            b'{"version":',
+            dumps(self.names.etag(version)),
+            b',"names":',
+            names,
+            b',"deleted":',
+            dumps(deleted),
+            b"}"
+        ])
+        return json_response(body)
 
 
 # create the application instance
@@ -230,8 +624,17 @@ api = swagger.docs(Api(app),
                    api_spec_url='/api/spec',
                    description='A REST API serving a names data structure')
 
+# encode the responses with the fastest JSON encoder installed
+api.representation("application/json")(output_json)
+encoding.init_app(app)
+
+# compress the responses the client accepts compressed
+compression.init_app(app)
+
 # connect our Names classes to the API processing
 api.add_resource(NamesList, "/api/names")
+api.add_resource(NamesExport, "/api/names/export")
+api.add_resource(NamesChanges, "/api/names/changes")
 api.add_resource(Names, "/api/names/<string:last_name>")
 
 
@@ -15,21 +15,28 @@
 
         // return the public API
         return {
-            get_names: function(lname) {
+            get_changes: function(since) {
                 var options = {
                     method: "GET",
-                    url: "api/names" + (lname ? "/" + lname : ""),
+                    url: "api/names/changes" + (since ? "?since=" + encodeURIComponent(since) : ""),
                     dataType: "json",
                     contentType: "application/json"
                 };
                 $.ajax(options)
                     .done(function(data) {
-                        $event_pump.trigger("get_names", {
-                            names_list: data
+                        $event_pump.trigger("get_changes", {
+                            since: since,
+                            changes: data
                         });
                     })
                     .fail(function(jqXHR, textStatus, errorThrown) {
-                        alert("failed to get names: " + textStatus);
+                        // the server can't tell us what changed since our
+                        // version any more, so we start over
+                        if (jqXHR.status === 410) {
+                            $event_pump.trigger("changes_gone");
+                        } else {
+                            alert("failed to get names: " + textStatus);
+                        }
                     });
             },
             update_name: function(data) {
@@ -126,10 +133,13 @@
             model = m,
             view = v,
             $fname = $("#fname"),
-            $lname = $("#lname");
+            $lname = $("#lname"),
+            names = {},
+            version = null;
 
-        // get the initial names list
-        model.get_names();
+        // get the initial names list, after that we only ask for
+        // what changed since the version of the list we have
+        model.get_changes(version);
 
         // initialize the view
         view.reset();
@@ -188,29 +198,53 @@
         });
 
         // handle the model events
-        $event_pump.on("get_names", function(e, data) {
+        $event_pump.on("get_changes", function(e, data) {
+            // without a version we asked for all the names
+            if (!data.since) {
+                names = {};
+            }
+
+            // apply the changes to our copy of the names list
+            $.each(data.changes.deleted, function(i, lname) {
+                delete names[lname];
+            });
+            $.each(data.changes.names, function(i, name) {
+                names[name.lname] = name;
+            });
+            version = data.changes.version;
+
             // update the view with the names list data
-            view.update_names_list(data);
+            view.update_names_list({
+                names_list: $.map(names, function(name) {
+                    return name;
+                })
+            });
+        });
+
+        $event_pump.on("changes_gone", function(e) {
+            // get the whole names list again
+            version = null;
+            model.get_changes(version);
         });
 
         $event_pump.on("update_name", function(e, data) {
-            // refresh the list of data
-            model.get_names();
+            // get the changes to the list of data
+            model.get_changes(version);
             view.reset();
             Materialize.toast("Name updated successfully", 4000, "rounded");
         });
 
         $event_pump.on("create_name", function(e, data) {
-            // refresh the list of names
-            model.get_names();
+            // get the changes to the list of names
+            model.get_changes(version);
             view.reset();
             Materialize.toast("Name created successfully", 4000, "rounded");
         })
 
         $event_pump.on("delete_name", function(e, data) {
-            // refresh the list of names
+            // get the changes to the list of names
             e.preventDefault();
-            model.get_names();
+            model.get_changes(version);
             view.reset();
             Materialize.toast("Name deleted successfully", 4000, "rounded");
         })
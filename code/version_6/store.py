@@ -0,0 +1,584 @@
+"""
+This module contains the in-memory names data structure,
+along with the pre-encoded JSON bodies the API serves
+"""
+
+# import python modules to create timestamps
+import time
+
+import bisect
+import sys
+import threading
+from collections import (
+    deque,
+    namedtuple
+)
+from functools import lru_cache
+
+from encoding import dumps
+
+
+# the format timestamps are rendered in
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def get_timestamp():
+    """
+    Get the current time, the store keeps timestamps as seconds
+    since the epoch and only formats them to encode a record
+    """
+    return time.time()
+
+
+@lru_cache(maxsize=4096)
+def parse_timestamp_string(timestamp):
+    return time.mktime(time.strptime(timestamp, TIMESTAMP_FORMAT))
+
+
+def parse_timestamp(timestamp):
+    """
+    Turn a timestamp, either seconds since the epoch or a string
+    in the TIMESTAMP_FORMAT, into seconds since the epoch
+    """
+    if isinstance(timestamp, str):
+        return parse_timestamp_string(timestamp)
+    return timestamp
+
+
+@lru_cache(maxsize=4096)
+def format_seconds(seconds):
+    return time.strftime(TIMESTAMP_FORMAT, time.localtime(seconds))
+
+
+def format_timestamp(timestamp):
+    """
+    Render seconds since the epoch in the TIMESTAMP_FORMAT. Names
+    written in the same second share the cached string
+    """
+    return format_seconds(int(timestamp))
+
+
+class NameRecord(object):
+    """
+    This class holds a name record in slots rather than a
+    dictionary, which takes about a third of the memory. Only the
+    name fields are kept, anything else a client sends is dropped,
+    and first names, which repeat a lot, are interned so the
+    records share one string for each
+    """
+    __slots__ = ("lname", "fname", "timestamp")
+
+    # the fields a client can write
+    FIELDS = ("lname", "fname")
+
+    def __init__(self, lname, fname, timestamp):
+        """
+        :param timestamp:   seconds since the epoch
+        """
+        self.lname = lname
+        self.fname = sys.intern(fname)
+        self.timestamp = timestamp
+
+    @staticmethod
+    def validate(data, required):
+        """
+        Check the name fields of a dictionary a client sent
+
+        :param required:    True if all the fields must be there
+        :raises ValueError: if the data isn't valid
+        """
+        if not isinstance(data, dict):
+            raise ValueError("A name must be a JSON object")
+        for field in NameRecord.FIELDS:
+            if field not in data:
+                if required:
+                    raise ValueError("{} is required".format(field))
+            elif not isinstance(data[field], str):
+                raise ValueError("{} must be a string".format(field))
+        if required and not data["lname"]:
+            raise ValueError("lname must not be empty")
+
+    @classmethod
+    def from_dict(cls, data, timestamp=None):
+        """
+        Build a record from a dictionary of name fields
+
+        :param timestamp:   the record's timestamp, by default the
+                            dictionary's, parsed by parse_timestamp()
+        :raises ValueError: if the data isn't valid
+        """
+        cls.validate(data, required=True)
+        if timestamp is None:
+            timestamp = parse_timestamp(data["timestamp"])
+        return cls(data["lname"], data["fname"], timestamp)
+
+    def replace(self, changes, timestamp):
+        """
+        Build a new record with the name fields in changes. The
+        store keys records by last name, so lname can't change
+
+        :raises ValueError: if the changes aren't valid
+        """
+        self.validate(changes, required=False)
+        if changes.get("lname", self.lname) != self.lname:
+            raise ValueError("lname can't be changed, create a name with the new one and delete this one")
+        return NameRecord(self.lname, changes.get("fname", self.fname), timestamp)
+
+    def to_dict(self):
+        """
+        Render the record as the dictionary the API sends
+        """
+        return {
+            "lname": self.lname,
+            "fname": self.fname,
+            "timestamp": format_timestamp(self.timestamp)
+        }
+
+
+def encode_record(record):
+    """
+    Encode a name record as the JSON bytes we send
+    """
+    # orjson's bytes keep the whole buffer it encoded into, a few
+    # kilobytes, so copy the body into bytes of its own size
+    return memoryview(dumps(record.to_dict())).tobytes()
+
+
+def remove_sorted(index, item):
+    """
+    Remove item from the sorted list index, if it's there
+    """
+    position = bisect.bisect_left(index, item)
+    if position < len(index) and index[position] == item:
+        del index[position]
+
+
+# number of index items a search copies out of an index at a time
+SCAN_WINDOW = 256
+
+# number of writes the change log remembers, a client further
+# behind than that has to fetch the whole list again
+CHANGE_LOG_SIZE = 10000
+
+
+class Entry(namedtuple("Entry", ["record", "body", "version"])):
+    """
+    This class holds a stored NameRecord, its JSON body and the
+    store version it was last written at
+    """
+    __slots__ = ()
+
+    @property
+    def last_modified(self):
+        # the record's timestamp, in seconds since the epoch
+        return self.record.timestamp
+
+
+def next_first_name_match(item, lname, matches):
+    """
+    Get the first_names index key to skip ahead to from item,
+    (first name, last name), when searching by first and last
+    name: the start of the last names matching within item's first
+    name, or the start of the next first name once they're past
+
+    :return:            the key, or None when item's last name matches
+    """
+    first_name, last_name = item
+    if last_name < lname:
+        return (first_name, lname)
+    if not matches(last_name, lname):
+        # every longer string sorts after first_name + "\0"
+        return (first_name + "\0",)
+    return None
+
+
+class NamesStore(object):
+    """
+    This class holds the names keyed by last name. Each record is
+    encoded to JSON once, when it's written, and the encoded list
+    of all the names is rebuilt from those bodies only on the first
+    read after a write, so reads never run the JSON encoder
+
+    The store is safe to share between threads. Entries are never
+    changed once they are stored, a write builds a new entry and
+    swaps it in with a single dictionary assignment, so readers
+    never lock and never see half updated records. Writers encode
+    outside the lock and only hold it to check the entry they
+    started from is still current, record the write in the journal,
+    if there is one, swap the new one in and bump the version, so
+    the journal has the writes in the order they were applied.
+    Snapshots rely on list(dict) being atomic in CPython
+
+    Two sorted indexes, maintained by the writers, keep paging and
+    searches by last name and by first name to a binary search
+    plus the names returned, however many names there are
+
+    The change log keeps the last CHANGE_LOG_SIZE writes, tagged
+    with the version they made, so a client holding a copy of the
+    list made at one version can fetch just what changed since
+    """
+    def __init__(self, records=None):
+        """
+        :param records:     dictionary of name record dictionaries
+                            keyed by last name
+        :raises ValueError: if a record isn't valid
+        """
+        # the store version is bumped by every write. boot_id keeps
+        # the etags of different runs of the server apart
+        self.boot_id = "{:x}".format(int(time.time() * 1000))
+        self.version = 0
+        self.last_modified = time.time()
+        self._entries = {}
+        self._list_body = (None, None)
+        self._lock = threading.Lock()
+
+        # (version, last name, body) of the latest writes, the body
+        # is None for a delete, and the oldest version they go back to
+        self._changes = deque(maxlen=CHANGE_LOG_SIZE)
+        self._changes_floor = 0
+
+        for last_name, record in (records or {}).items():
+            record = NameRecord.from_dict(record)
+            self._entries[last_name] = Entry(record, encode_record(record), 0)
+
+        # the sorted last names, and the sorted (first name, last name) pairs
+        self._last_names = sorted(self._entries)
+        self._first_names = sorted(
+            (entry.record.fname, last_name)
+            for last_name, entry in self._entries.items()
+        )
+
+        # the log every write is recorded in, see persistence.py
+        self.journal = None
+
+    @classmethod
+    def from_entries(cls, entries, last_names, first_names):
+        """
+        Build a store from entries and indexes that are already
+        built and sorted, as a snapshot holds them, which skips
+        encoding and sorting all the names again
+
+        :param entries:     dictionary of Entries keyed by last name
+        :param last_names:  the sorted last names
+        :param first_names: the sorted (first name, last name) pairs
+        """
+        store = cls()
+        store._entries = entries
+        store._last_names = last_names
+        store._first_names = first_names
+        return store
+
+    def snapshot(self, during=None):
+        """
+        Copy the entries and the indexes as they are at one moment
+
+        :param during:      function called while the writers are
+                            held off, after the copy is taken
+        :return:            (entries, last names, first names)
+        """
+        with self._lock:
+            copy = (dict(self._entries), list(self._last_names), list(self._first_names))
+            if during is not None:
+                during()
+        return copy
+
+    def __contains__(self, last_name):
+        return last_name in self._entries
+
+    def __iter__(self):
+        # iterate over a snapshot of the keys so writes can't
+        # change the dictionary under the iterator
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, last_name):
+        """
+        Get the entry for last_name, or None
+        """
+        return self._entries.get(last_name)
+
+    def entries(self):
+        """
+        Get a snapshot list of all the entries
+        """
+        return list(self._entries.values())
+
+    def page(self, after=None, limit=100):
+        """
+        Get up to limit (last name, entry) pairs ordered by last name,
+        starting after the last name passed in
+        """
+        start = bisect.bisect_right(self._last_names, after) if after is not None else 0
+        last_names = self._last_names[start:start + limit]
+
+        # a write between the bisect and the slice can shift the index
+        pairs = (
+            (last_name, self._entries.get(last_name)) for last_name in last_names
+            if after is None or last_name > after
+        )
+        return [(last_name, entry) for last_name, entry in pairs if entry is not None]
+
+    def search(self, fname=None, lname=None, prefix=False, limit=100):
+        """
+        Get up to limit entries whose first and/or last name match.
+        Searches by first name are ordered by first then last name,
+        searches by last name alone by last name
+
+        :param fname:       the first name to match, or None
+        :param lname:       the last name to match, or None
+        :param prefix:      match names starting with fname and lname,
+                            rather than equal to them
+        """
+        def matches(value, wanted):
+            return wanted is None or (value.startswith(wanted) if prefix else value == wanted)
+
+        skip = None
+        if fname is not None:
+            index = self._first_names
+            start = bisect.bisect_left(index, (fname, lname or ""))
+            in_range = lambda item: matches(item[0], fname)
+            last_name_of = lambda item: item[1]
+            if lname is not None:
+                skip = lambda item: next_first_name_match(item, lname, matches)
+        else:
+            index = self._last_names
+            start = bisect.bisect_left(index, lname or "")
+            in_range = lambda item: matches(item, lname)
+            last_name_of = lambda item: item
+
+        # walk the index a window at a time from the first possible
+        # match, a write between windows can shift the index, so every
+        # item is checked again and duplicates are skipped
+        entries = []
+        seen = set()
+        while len(entries) < limit:
+            window = index[start:start + SCAN_WINDOW]
+            if not window:
+                break
+            position = 0
+            while position < len(window):
+                item = window[position]
+                if not in_range(item):
+                    return entries
+
+                # jump over the index entries whose last name can't
+                # match, within the window or to where it starts next
+                target = skip(item) if skip is not None else None
+                if target is not None:
+                    position = bisect.bisect_left(window, target, position)
+                    if position == len(window):
+                        start = bisect.bisect_left(index, target)
+                        break
+                    continue
+                position += 1
+
+                last_name = last_name_of(item)
+                entry = self._entries.get(last_name)
+                if entry is None or last_name in seen or not matches(last_name, lname):
+                    continue
+                if fname is not None and entry.record.fname != item[0]:
+                    continue
+                seen.add(last_name)
+                entries.append(entry)
+                if len(entries) == limit:
+                    break
+            else:
+                start += len(window)
+        return entries
+
+    def etag(self, version):
+        """
+        Build the etag for a store version
+        """
+        return "{}-{}".format(self.boot_id, version)
+
+    def version_of(self, etag):
+        """
+        Get the store version an etag built by etag() stands for
+
+        :return:            the version, or None if the etag is from
+                            another run of the server, or isn't one
+        """
+        boot_id, _, version = etag.rpartition("-")
+        if boot_id != self.boot_id or not version.isdigit():
+            return None
+        return int(version)
+
+    def changes(self, since):
+        """
+        Get the names written after store version since, only the
+        latest write of each name
+
+        :return:            (the current version, list of (last name,
+                            body) pairs in the order the names were
+                            first written, the body is None for a
+                            deleted name), or None when the change
+                            log doesn't go back to since
+        """
+        with self._lock:
+            version = self.version
+            if not self._changes_floor <= since <= version:
+                return None
+            changes = list(self._changes) if since < version else []
+
+        latest = {}
+        for change_version, last_name, body in changes:
+            if change_version > since:
+                latest[last_name] = body
+        return version, list(latest.items())
+
+    def list_body(self):
+        """
+        Get the JSON body of the list of all names
+        """
+        # writers store their entry before bumping the version, so a
+        # snapshot taken after reading the version is at least that new
+        version = self.version
+        body_version, body = self._list_body
+        if body_version != version:
+            bodies = [entry.body for entry in self.entries()]
+            body = b"[" + b",".join(bodies) + b"]"
+            self._list_body = (version, body)
+        return body
+
+    def _store(self, last_name, record, expected):
+        """
+        Encode record and swap in a new entry for it, if the
+        current entry for last_name is still the expected one
+
+        :return:            the new entry, or None if the entry
+                            changed since the caller read it
+        """
+        body = encode_record(record)
+        with self._lock:
+            current = self._entries.get(last_name)
+            if expected is not None and current is not expected:
+                return None
+            entry = Entry(record, body, self.version + 1)
+            if self.journal is not None:
+                self.journal.record_store(last_name, record)
+            self._entries[last_name] = entry
+            self._index(last_name, current, entry)
+            self._changed(last_name, body)
+        return entry
+
+    def _index(self, last_name, old, new):
+        # call holding the lock, move last_name in the indexes
+        if old is None:
+            bisect.insort(self._last_names, last_name)
+        else:
+            remove_sorted(self._first_names, (old.record.fname, last_name))
+        if new is None:
+            remove_sorted(self._last_names, last_name)
+        else:
+            bisect.insort(self._first_names, (new.record.fname, last_name))
+
+    def _changed(self, last_name, body):
+        # call holding the lock, after the entries are updated, with
+        # the new body of last_name, or None when it was deleted
+        self.version += 1
+        self.last_modified = time.time()
+        if len(self._changes) == self._changes.maxlen:
+            # the oldest change drops out of the log
+            self._changes_floor = self._changes[0][0]
+        self._changes.append((self.version, last_name, body))
+
+    def create(self, record):
+        """
+        Add a record, replacing any record with the same last name
+
+        :param record:      dictionary of the name fields, the
+                            record is timestamped here
+        :return:            the new entry
+        :raises ValueError: if the record isn't valid
+        """
+        record = NameRecord.from_dict(record, timestamp=get_timestamp())
+        return self._store(record.lname, record, None)
+
+    def restore(self, writes):
+        """
+        Apply the writes persistence.py logged, rebuilding each
+        index once rather than moving names in it write by write,
+        which costs a copy of the index per write
+
+        :param writes:      list of (last name, NameRecord) pairs in
+                            the order they were written, the record
+                            is None for a delete
+        """
+        # only the last write of each name counts
+        latest = dict(writes)
+        with self._lock:
+            removed_last_names = set()
+            removed_first_names = set()
+            added_last_names = []
+            added_first_names = []
+            for last_name, record in latest.items():
+                old = self._entries.pop(last_name, None)
+                if old is not None:
+                    removed_first_names.add((old.record.fname, last_name))
+                    if record is None:
+                        removed_last_names.add(last_name)
+                if record is not None:
+                    self._entries[last_name] = Entry(record, encode_record(record), self.version + 1)
+                    added_first_names.append((record.fname, last_name))
+                    if old is None:
+                        added_last_names.append(last_name)
+
+            # sorting a sorted list with a few names added to its end
+            # is little more than a merge
+            if removed_last_names or added_last_names:
+                self._last_names = sorted(
+                    [last_name for last_name in self._last_names if last_name not in removed_last_names]
+                    + added_last_names
+                )
+            if removed_first_names or added_first_names:
+                self._first_names = sorted(
+                    [pair for pair in self._first_names if pair not in removed_first_names]
+                    + added_first_names
+                )
+
+            # the restored writes aren't in the change log, so no
+            # client can catch up across them
+            self.version += 1
+            self.last_modified = time.time()
+            self._changes.clear()
+            self._changes_floor = self.version
+
+    def update(self, last_name, changes):
+        """
+        Update the fname of the record for last_name
+
+        :param changes:     dictionary with the new field values
+        :return:            the new entry, or None if there is no record
+        :raises ValueError: if the changes aren't valid
+        """
+        while True:
+            entry = self._entries.get(last_name)
+            if entry is None:
+                return None
+
+            record = entry.record.replace(changes, get_timestamp())
+
+            # try again if another writer got in first
+            new_entry = self._store(last_name, record, entry)
+            if new_entry is not None:
+                return new_entry
+
+    def delete(self, last_name):
+        """
+        Delete the record for last_name
+
+        :return:            True if there was a record to delete
+        """
+        with self._lock:
+            entry = self._entries.get(last_name)
+            if entry is None:
+                return False
+            if self.journal is not None:
+                self.journal.record_delete(last_name)
+            del self._entries[last_name]
+            self._index(last_name, entry, None)
+            self._changed(last_name, None)
+        return True
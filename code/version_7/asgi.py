@@ -0,0 +1,542 @@
+"""
+This module serves the names API as an asyncio ASGI
+application, so idle keep-alive connections cost a coroutine
+rather than a thread. The responses match the flask_restful
+Names, NamesList and NamesChanges resources in presentation.py
+
+It also streams the names' changes as Server-Sent Events at
+/api/names/events, see events.py.
+
+Run it with any ASGI server, for example:
+
+    NAMES_CACHE_TTL=0 uvicorn asgi:application --workers 4
+
+turning the model's cache off, as serve.py does, when there's more
+than one worker.
+"""
+
+import asyncio
+import calendar
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from flask_restful import (
+    abort,
+    inputs
+)
+from sqlalchemy.orm.exc import NoResultFound
+from werkzeug.datastructures import Accept
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import (
+    parse_accept_header,
+    parse_date,
+    parse_etags
+)
+
+# import the flask application and model, the model needs the
+# application's configuration and context to talk to the database
+from application import app
+from compression import (
+    COMPRESSIBLE_TYPES,
+    CompressionCache,
+    add_vary,
+    choose_encoding,
+    compress_body,
+    weak_etag
+)
+from encoding import dumps
+from model import (
+    db,
+    name_record
+)
+from presentation import (
+    BROADCASTER,
+    CHANGE_POLLER,
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    MODEL,
+    decode_cursor,
+    encode_cursor,
+    list_validators,
+    to_epoch,
+    validate_name,
+    validator_headers
+)
+
+
+# number of threads running blocking model calls
+app.config.setdefault("ASGI_DB_THREADS", 8)
+
+# seconds between the comments that keep an idle event stream open
+app.config.setdefault("EVENTS_KEEPALIVE", 15.0)
+
+
+def serialize_names(names):
+    return [name_record(name) for name in names]
+
+
+def serialize_versioned_names(versioned):
+    version, names = versioned
+    return version, serialize_names(names)
+
+
+def serialize_name(name):
+    # a write only queued with enqueue durability returns None
+    if name is None:
+        return None, None
+    return name_record(name), name.timestamp
+
+
+def serialize_changes(changes):
+    if changes is None:
+        return None
+    version, names, deleted = changes
+    return {"version": str(version), "names": serialize_names(names), "deleted": deleted}
+
+
+class AsyncModel(object):
+    """
+    This class gives the model an async interface by running
+    each call on a thread pool, inside an application context.
+    Names are serialized on the pool thread too, while their
+    session can still load any expired attributes
+    """
+    def __init__(self, model, threads):
+        self.model = model
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def _call(self, convert, method, args, kwargs):
+        with app.app_context():
+            try:
+                retval = method(*args, **kwargs)
+                return convert(retval) if convert is not None else retval
+            finally:
+                # hand the connection back to the pool
+                db.session.remove()
+
+    async def call(self, convert, name, *args, **kwargs):
+        method = getattr(self.model, name)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._call, convert, method, args, kwargs)
+
+    async def get_names(self):
+        return await self.call(serialize_names, "get_names")
+
+    async def get_versioned_names(self):
+        return await self.call(serialize_versioned_names, "get_versioned_names")
+
+    async def get_names_page(self, limit, after=None):
+        return await self.call(serialize_names, "get_names_page", limit, after=after)
+
+    async def search_names(self, first_name=None, last_name=None, prefix=False, limit=100):
+        return await self.call(serialize_names, "search_names",
+                               first_name=first_name, last_name=last_name, prefix=prefix, limit=limit)
+
+    async def get_names_version(self):
+        return await self.call(tuple, "get_names_version")
+
+    async def get_changes(self, since=None):
+        return await self.call(serialize_changes, "get_changes", since)
+
+    async def get_name(self, last_name):
+        return await self.call(serialize_name, "get_name", last_name)
+
+    async def create_name(self, last_name, first_name):
+        return await self.call(serialize_name, "create_name", last_name, first_name)
+
+    async def update_name(self, last_name, first_name=None):
+        return await self.call(serialize_name, "update_name", last_name, first_name=first_name)
+
+    async def delete_name(self, last_name):
+        return await self.call(None, "delete_name", last_name)
+
+
+ASYNC_MODEL = AsyncModel(MODEL, app.config["ASGI_DB_THREADS"])
+
+
+class Request(object):
+    """
+    This class holds the parts of an ASGI http scope the
+    handlers need
+    """
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query_string = scope.get("query_string", b"").decode("latin-1")
+        self.args = {
+            key: values[-1]
+            for key, values in parse_qs(self.query_string).items()
+        }
+        self.headers = {
+            key.decode("latin-1").lower(): value.decode("latin-1")
+            for key, value in scope.get("headers", [])
+        }
+        self.body = body
+
+    def get_json(self):
+        try:
+            return json.loads(self.body.decode("utf-8")) if self.body else None
+        except ValueError:
+            return None
+
+
+def json_response(data, status=200, headers=None):
+    """
+    Build a (status, headers, body) response holding data as JSON
+    """
+    headers = dict(headers or {})
+    headers["Content-Type"] = "application/json"
+    return status, headers, dumps(data) + b"\n"
+
+
+def error_response(status, message=None):
+    return json_response({"message": message} if message else {}, status=status)
+
+
+def not_modified(request, etag, last_modified):
+    """
+    Check the request's If-None-Match and If-Modified-Since
+    headers, as presentation.not_modified() does
+
+    :return:        a 304 response, or None if the client needs the payload
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = parse_date(request.headers.get("if-modified-since"))
+    if if_none_match:
+        matched = parse_etags(if_none_match).contains_weak(etag)
+    elif if_modified_since is not None and last_modified is not None:
+        matched = int(last_modified) <= calendar.timegm(if_modified_since.utctimetuple())
+    else:
+        matched = False
+
+    if not matched:
+        return None
+    return 304, validator_headers(etag, last_modified), b""
+
+
+def get_page_arguments(request):
+    """
+    Get the paging arguments, as presentation.get_page_arguments() does
+    """
+    if "limit" not in request.args and "cursor" not in request.args:
+        return None, None
+
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = 0
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    cursor = request.args.get("cursor")
+    after = decode_cursor(cursor) if cursor else None
+    return limit, after
+
+
+def get_search_arguments(request):
+    """
+    Get the search arguments, as presentation.get_search_arguments() does
+
+    :return:        (fname, lname, prefix), or None when the request
+                    isn't a search
+    """
+    try:
+        prefix = inputs.boolean(request.args.get("prefix", False))
+    except ValueError as e:
+        # the message reqparse gives for an invalid argument
+        abort(400, message={"prefix": str(e)})
+    fname = request.args.get("fname")
+    lname = request.args.get("lname")
+    if fname is None and lname is None:
+        return None
+    if "cursor" in request.args:
+        raise ValueError("A search can't be paged with a cursor")
+    return fname, lname, prefix
+
+
+async def get_names(request):
+    """
+    Get the entire list of names, a page of it, or the names
+    matching a search by fname and/or lname
+    """
+    try:
+        limit, after = get_page_arguments(request)
+        search = get_search_arguments(request)
+    except ValueError as e:
+        return error_response(400, str(e))
+
+    etag, last_modified = list_validators(await ASYNC_MODEL.get_names_version())
+
+    # does the client already have this version of the list?
+    rsp = not_modified(request, etag, last_modified)
+    if rsp is not None:
+        return rsp
+
+    if search is not None:
+        fname, lname, prefix = search
+        retval = await ASYNC_MODEL.search_names(first_name=fname,
+                                                last_name=lname,
+                                                prefix=prefix,
+                                                limit=limit or MAX_PAGE_SIZE)
+    elif limit is None:
+        # with the validators of the version the list was read at
+        version, retval = await ASYNC_MODEL.get_versioned_names()
+        etag, last_modified = list_validators(version)
+    else:
+        names = await ASYNC_MODEL.get_names_page(limit + 1, after=after)
+        next_cursor = encode_cursor(names[limit - 1]["lname"]) if len(names) > limit else None
+        retval = {
+            "names": names[:limit],
+            "next": next_cursor
+        }
+    return json_response(retval, headers=validator_headers(etag, last_modified))
+
+
+async def get_changes(request):
+    """
+    Get the changes to the names since a version of the list, as
+    presentation.get_changes() does
+    """
+    since = request.args.get("since")
+    changes = None
+    if since is None or since.isdigit():
+        changes = await ASYNC_MODEL.get_changes(int(since) if since is not None else None)
+    if changes is None:
+        return error_response(410, "The changes since {} are gone, fetch all the names".format(since))
+    return json_response(changes)
+
+
+async def create_name(request):
+    """
+    Create a new record in the names structure
+    """
+    post_data = request.get_json()
+    try:
+        validate_name(post_data, required=True)
+    except ValueError as e:
+        return error_response(400, str(e))
+
+    record, timestamp = await ASYNC_MODEL.create_name(post_data["lname"], first_name=post_data["fname"])
+    if record is None:
+        return 202, {}, b""
+    return json_response(record, status=201)
+
+
+async def get_name(request, last_name):
+    """
+    Get a particular name record
+    """
+    try:
+        record, timestamp = await ASYNC_MODEL.get_name(last_name)
+    except NoResultFound:
+        return error_response(404)
+
+    last_modified = to_epoch(timestamp)
+    etag = "{:x}".format(int(last_modified * 1e6))
+
+    # does the client already have this version of the record?
+    rsp = not_modified(request, etag, last_modified)
+    if rsp is not None:
+        return rsp
+
+    return json_response(record, headers=validator_headers(etag, last_modified))
+
+
+async def update_name(request, last_name):
+    """
+    Update a name record
+    """
+    put_data = request.get_json()
+    try:
+        validate_name(put_data, required=False)
+    except ValueError as e:
+        return error_response(400, str(e))
+
+    try:
+        record, timestamp = await ASYNC_MODEL.update_name(last_name, first_name=put_data.get("fname"))
+    except NoResultFound:
+        return error_response(404)
+    if record is None:
+        return 202, {}, b""
+    return json_response(record, status=201)
+
+
+async def delete_name(request, last_name):
+    """
+    Delete a name record
+    """
+    try:
+        await ASYNC_MODEL.delete_name(last_name)
+    except NoResultFound:
+        return error_response(404)
+    return 204, {}, b""
+
+
+# the handlers for /api/names and /api/names/<last_name>, by method
+LIST_HANDLERS = {
+    "GET": get_names,
+    "POST": create_name
+}
+NAME_HANDLERS = {
+    "GET": get_name,
+    "PUT": update_name,
+    "DELETE": delete_name
+}
+
+
+async def dispatch(request):
+    """
+    Route a request to its handler
+
+    :return:        (status, headers, body)
+    """
+    path = request.path.rstrip("/")
+    if path == "/api/names":
+        handler = LIST_HANDLERS.get(request.method)
+        args = ()
+    elif path == "/api/names/changes":
+        handler = get_changes if request.method == "GET" else None
+        args = ()
+    elif path.startswith("/api/names/") and "/" not in path[len("/api/names/"):]:
+        handler = NAME_HANDLERS.get(request.method)
+        # the server has already percent-decoded the path, as
+        # werkzeug has PATH_INFO, so the last name is used as is
+        args = (path[len("/api/names/"):],)
+    else:
+        return error_response(404)
+
+    if handler is None:
+        return error_response(405)
+
+    try:
+        return await handler(request, *args)
+    except HTTPException as e:
+        data = getattr(e, "data", None) or {"message": e.description}
+        return json_response(data, status=e.code)
+    except Exception as e:
+        app.logger.error(str(e), exc_info=True)
+        return error_response(500)
+
+
+COMPRESSION_CACHE = CompressionCache(size=app.config["COMPRESS_CACHE_SIZE"])
+
+
+async def compress_response(request, status, headers, body):
+    """
+    Compress a response the way compression.init_app() does for
+    the flask application, on a thread so a big body doesn't hold
+    up the event loop
+
+    :return:        (status, headers, body)
+    """
+    if (status < 200 or status in (204, 304)
+            or not headers.get("Content-Type", "").startswith(COMPRESSIBLE_TYPES)):
+        return status, headers, body
+
+    add_vary(headers)
+    encoding = choose_encoding(parse_accept_header(request.headers.get("accept-encoding"), Accept))
+    if encoding is None or len(body) < app.config["COMPRESS_MIN_SIZE"]:
+        return status, headers, body
+
+    etag = headers.get("ETag")
+    url = request.path + ("?" + request.query_string if request.query_string else "")
+    loop = asyncio.get_event_loop()
+    body = await loop.run_in_executor(
+        None, compress_body, COMPRESSION_CACHE, body, encoding, url, etag,
+        app.config["COMPRESS_LEVEL"], app.config["COMPRESS_BROTLI_QUALITY"]
+    )
+    headers["Content-Encoding"] = encoding
+    if etag:
+        headers["ETag"] = weak_etag(etag)
+    return status, headers, body
+
+
+async def stream_events(request, receive, send):
+    """
+    Stream the names' create, update and delete events to the
+    client until it disconnects. Each event's data is the list of
+    last names it changed, a resync event means events were dropped
+    and the client should fetch the list again
+    """
+    # in case the server didn't send the lifespan startup event
+    CHANGE_POLLER.start()
+    subscriber = BROADCASTER.subscribe(request.headers.get("last-event-id"))
+
+    async def wait_for_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        subscriber.close()
+
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                # stop proxies buffering the stream
+                (b"x-accel-buffering", b"no")
+            ]
+        })
+        await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+        while not subscriber.closed:
+            events = await subscriber.get(timeout=app.config["EVENTS_KEEPALIVE"])
+            if subscriber.closed:
+                break
+            await send({"type": "http.response.body", "body": events or b": keepalive\n\n", "more_body": True})
+    finally:
+        BROADCASTER.unsubscribe(subscriber)
+        watcher.cancel()
+
+
+async def read_body(receive):
+    body = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        body.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(body)
+
+
+async def application(scope, receive, send):
+    """
+    The ASGI entry point
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                CHANGE_POLLER.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                ASYNC_MODEL.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    request = Request(scope, await read_body(receive))
+    if request.method == "GET" and request.path.rstrip("/") == "/api/names/events":
+        await stream_events(request, receive, send)
+        return
+
+    status, headers, body = await compress_response(request, *await dispatch(request))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (key.encode("latin-1"), value.encode("latin-1"))
+            for key, value in headers.items()
+        ]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+# if we're running in stand alone mode, run the application
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application)
@@ -0,0 +1,159 @@
+"""
+This module contains a read through cache that sits in
+front of the model so hot names are served from memory
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# keys the cached names list snapshot, along with the version it
+# was read at, and the current version of the list are stored under
+NAMES_LIST_KEY = ("names",)
+NAMES_VERSION_KEY = ("names_version",)
+
+# marker for a key that isn't in the cache
+MISSING = object()
+
+
+class LRUCache(object):
+    """
+    This class is a bounded, thread safe, least recently used
+    cache whose entries expire after a time to live
+    """
+    def __init__(self, size=1024, ttl=1.0):
+        """
+        :param size:    the most entries the cache holds
+        :param ttl:     seconds an entry is served for, None to never
+                        expire, 0 to cache nothing
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get the value cached under key, or MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def set(self, key, value, generation=None):
+        """
+        Cache value under key, evicting the least recently used
+        entry if the cache is full
+
+        :param generation:  the cache generation read before loading
+                            value, if there has been an invalidation
+                            since then value may be stale and isn't cached
+        """
+        if self.ttl == 0:
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """
+        Drop the entries cached under keys
+        """
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Drop all the entries
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Get the cache counters
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+class CachedModel(object):
+    """
+    This class wraps a Model, serving get_name and get_names
+    from an LRU cache and invalidating the names a write
+    touches. Each process has its own cache, so the time to live
+    bounds how stale a name changed by another process can be,
+    including the list version its ETag is built from
+    """
+    def __init__(self, model, size=1024, ttl=1.0):
+        self.model = model
+        self.cache = LRUCache(size=size, ttl=ttl)
+        model.subscribe(self._names_changed)
+
+    def __getattr__(self, attribute):
+        # anything we don't cache goes straight to the model
+        return getattr(self.model, attribute)
+
+    @staticmethod
+    def _names_keys(*last_names):
+        # the keys a write to last_names makes stale
+        return [NAMES_LIST_KEY, NAMES_VERSION_KEY] + [("name", last_name) for last_name in last_names]
+
+    def _names_changed(self, action, last_names):
+        # writes go straight to the model, which tells us what they changed
+        self.cache.invalidate(*self._names_keys(*last_names))
+
+    def get_names(self):
+        return self.get_versioned_names()[1]
+
+    def get_versioned_names(self):
+        # the list and its version are one entry, so they expire
+        # together and the list is never served under a newer version
+        versioned = self.cache.get(NAMES_LIST_KEY)
+        if versioned is MISSING:
+            generation = self.cache.generation
+            versioned = self.model.get_versioned_names()
+            self.cache.set(NAMES_LIST_KEY, versioned, generation=generation)
+        return versioned
+
+    def get_names_version(self):
+        version = self.cache.get(NAMES_VERSION_KEY)
+        if version is MISSING:
+            generation = self.cache.generation
+            version = tuple(self.model.get_names_version())
+            self.cache.set(NAMES_VERSION_KEY, version, generation=generation)
+        return version
+
+    def get_name(self, last_name):
+        key = ("name", last_name)
+        name = self.cache.get(key)
+        if name is MISSING:
+            generation = self.cache.generation
+            name = self.model.get_name(last_name)
+            self.cache.set(key, name, generation=generation)
+        return name
@@ -0,0 +1,161 @@
+"""
+This module compresses responses with brotli or gzip, whichever
+the client accepts, brotli only when it's installed. Bodies
+smaller than COMPRESS_MIN_SIZE aren't worth it and are sent
+as they are, and so are streamed responses.
+
+Compressing a big body costs much more than sending it, so the
+compressed bytes are cached, keyed by the URL and ETag of the
+response or, when it has none, by a digest of the body. The
+same list snapshot or swagger spec is only compressed once
+"""
+
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# the content types worth compressing
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "text/"
+)
+
+
+def choose_encoding(accept_encoding):
+    """
+    Pick the encoding to compress a response with
+
+    :param accept_encoding:     werkzeug Accept of the request's
+                                Accept-Encoding header
+    :return:                    "br", "gzip" or None
+    """
+    if brotli is not None and accept_encoding["br"] > 0:
+        return "br"
+    if accept_encoding["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+def compress(body, encoding, level=6, quality=5):
+    """
+    Compress body with encoding
+
+    :param level:       the gzip compression level
+    :param quality:     the brotli quality
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=quality)
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def weak_etag(etag):
+    """
+    Make a response's ETag weak, the compressed body isn't the
+    same bytes as the one it was computed for
+    """
+    if etag and not etag.startswith("W/"):
+        return "W/" + etag
+    return etag
+
+
+def add_vary(headers):
+    vary = headers.get("Vary")
+    if not vary:
+        headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        headers["Vary"] = vary + ", Accept-Encoding"
+
+
+class CompressionCache(object):
+    """
+    This class holds the most recently compressed bodies
+    """
+    def __init__(self, size=64):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def compress_body(cache, body, encoding, url, etag, level=6, quality=5):
+    """
+    Get body compressed with encoding, from the cache if it has
+    been compressed before
+
+    :param url:     the URL, with its query string, that sent body
+    :param etag:    the body's ETag header, or None
+    """
+    if etag:
+        key = (encoding, url, etag)
+    else:
+        key = (encoding, hashlib.sha1(body).digest())
+
+    compressed = cache.get(key)
+    if compressed is None:
+        compressed = compress(body, encoding, level=level, quality=quality)
+        cache.set(key, compressed)
+    return compressed
+
+
+def init_app(app):
+    """
+    Compress the responses of app
+    """
+    app.config.setdefault("COMPRESS_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESS_LEVEL", 6)
+    app.config.setdefault("COMPRESS_BROTLI_QUALITY", 5)
+    app.config.setdefault("COMPRESS_CACHE_SIZE", 64)
+    cache = CompressionCache(size=app.config["COMPRESS_CACHE_SIZE"])
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough or response.is_streamed
+                or "Content-Encoding" in response.headers
+                or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)):
+            return response
+
+        # the body depends on the Accept-Encoding header, whether
+        # or not this one gets compressed
+        add_vary(response.headers)
+
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        body = response.get_data()
+        if len(body) < app.config["COMPRESS_MIN_SIZE"]:
+            return response
+
+        etag = response.headers.get("ETag")
+        response.set_data(compress_body(
+            cache, body, encoding, request.full_path, etag,
+            level=app.config["COMPRESS_LEVEL"],
+            quality=app.config["COMPRESS_BROTLI_QUALITY"]
+        ))
+        response.headers["Content-Encoding"] = encoding
+        if etag:
+            response.headers["ETag"] = weak_etag(etag)
+        return response
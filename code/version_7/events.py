@@ -0,0 +1,299 @@
+"""
+This module pushes the model's changes to clients as Server-Sent
+Events. A ChangePoller thread in each process tails the
+name_change log the names table's triggers fill, and publishes
+what it reads to the process's Broadcaster, so every create,
+update and delete is published once it's committed, whichever
+worker, resource or thread made it. An event's id is the id of
+its last change, the same in every worker, so a client can
+reconnect to any of them.
+
+Each event is encoded once, whatever the number of subscribers,
+and handed to each event loop serving subscribers with a single
+thread safe call, the loop then queues it for its subscribers.
+A subscriber is a coroutine and a queue rather than a thread, so
+thousands of open streams cost little more than one. asgi.py
+serves the stream at /api/names/events.
+
+A subscriber's queue is bounded. When a client falls that far
+behind, the events it hasn't read are dropped and it's sent a
+resync event instead, telling it to fetch the list again, so a
+slow client never holds on to memory or holds up the others.
+The poller does the same when the log has dropped changes it
+hadn't read yet
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from itertools import groupby
+
+from application import app
+from encoding import dumps
+from model import db
+
+
+# the event sent in place of the events a subscriber missed
+RESYNC = "resync"
+
+
+def encode_event(event_id, event, data):
+    """
+    Encode an event in the text/event-stream format
+
+    :param event_id:    the id a reconnecting client sends back
+                        in its Last-Event-ID header
+    :param event:       the event type
+    :param data:        the JSON serializeable data
+    """
+    return b"".join([
+        b"id: ", event_id.encode("utf-8"),
+        b"\nevent: ", event.encode("utf-8"),
+        b"\ndata: ", dumps(data),
+        b"\n\n"
+    ])
+
+
+class Subscriber(object):
+    """
+    This class queues the events for one client. It's only used
+    from the event loop the client is served on
+    """
+    def __init__(self, broadcaster, size):
+        """
+        :param size:        the most events queued before the client
+                            is told to resync instead
+        """
+        self.broadcaster = broadcaster
+        self.size = size
+        self.sequence = 0
+        self.closed = False
+        self._messages = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, sequence, message):
+        """
+        Queue an encoded event, unless the subscriber has already
+        been sent the event with that sequence number
+        """
+        if sequence <= self.sequence or self.closed:
+            return
+        self.sequence = sequence
+        if len(self._messages) >= self.size:
+            # the client isn't keeping up
+            self.broadcaster.resyncs += 1
+            self.resync()
+            return
+        self._messages.append(message)
+        self._ready.set()
+
+    def resync(self):
+        """
+        Drop the queued events and tell the client to fetch the
+        list again instead
+        """
+        self._messages.clear()
+        self._messages.append(encode_event(self.broadcaster.event_id(self.sequence), RESYNC, {}))
+        self._ready.set()
+
+    def close(self):
+        """
+        Wake up the stream so it sees the client has gone
+        """
+        self.closed = True
+        self._ready.set()
+
+    async def get(self, timeout=None):
+        """
+        Wait for events
+
+        :param timeout:     seconds to wait
+        :return:            the queued events, in one string of bytes,
+                            or None if there were none in time or the
+                            subscriber is closed
+        """
+        if not self._messages and not self.closed:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._ready.clear()
+        if self.closed or not self._messages:
+            return None
+        messages = b"".join(self._messages)
+        self._messages.clear()
+        return messages
+
+
+class Broadcaster(object):
+    """
+    This class publishes the model's changes to the subscribers.
+    It keeps the last history events, so a client reconnecting
+    with a Last-Event-ID can catch up on the events it missed.
+    The sequence numbers are change log ids, an event's is the id
+    of its last change
+    """
+    def __init__(self, history=1024, queue_size=256):
+        """
+        :param history:     events kept for reconnecting clients
+        :param queue_size:  events queued per subscriber
+        """
+        self.queue_size = queue_size
+        self.resyncs = 0
+        self._sequence = 0
+        self._history = deque(maxlen=history)
+        self._loops = {}
+        self._lock = threading.Lock()
+
+    def event_id(self, sequence):
+        return str(sequence)
+
+    def begin(self, sequence):
+        """
+        Start publishing after change sequence, forgetting the
+        events before it
+        """
+        with self._lock:
+            self._sequence = sequence
+            self._history.clear()
+
+    def publish(self, sequence, action, last_names):
+        """
+        Publish a change
+
+        :param sequence:    the id of the change, after the last one
+                            published
+        :param action:      "create", "update", "delete" or RESYNC
+        :param last_names:  the names changed
+        """
+        data = {"lnames": list(last_names)} if action != RESYNC else {}
+        with self._lock:
+            # each event is kept with the sequence a client must have
+            # seen to catch up from it
+            previous, self._sequence = self._sequence, sequence
+            message = encode_event(self.event_id(sequence), action, data)
+            self._history.append((previous, sequence, message))
+
+            # wake each loop once, in order, while holding the lock
+            for loop in list(self._loops):
+                try:
+                    loop.call_soon_threadsafe(self._deliver, loop, sequence, message)
+                except RuntimeError:
+                    # the loop has closed
+                    del self._loops[loop]
+
+    def _deliver(self, loop, sequence, message):
+        # runs on loop, the only thread changing its subscribers
+        for subscriber in list(self._loops.get(loop, ())):
+            subscriber.put(sequence, message)
+
+    def _missed(self, sequence):
+        # call holding the lock, get the (sequence, message) pairs
+        # after sequence, or None if they aren't all kept
+        oldest = self._history[0][0] if self._history else self._sequence
+        if sequence < oldest:
+            return None
+        return [(number, message) for previous, number, message in self._history if number > sequence]
+
+    def subscribe(self, last_event_id=None):
+        """
+        Add a subscriber served on the running event loop
+
+        :param last_event_id:   the id of the last event the client
+                                saw, it's sent the events after it,
+                                or a resync if they're gone
+        :return:                the Subscriber
+        """
+        loop = asyncio.get_running_loop()
+        subscriber = Subscriber(self, self.queue_size)
+        seen = int(last_event_id) if last_event_id and last_event_id.isdigit() else None
+        with self._lock:
+            missed = self._missed(seen) if seen is not None else None
+            for sequence, message in missed or []:
+                subscriber.put(sequence, message)
+
+            # skip the events published before now, still on their
+            # way to the loop, and those a client coming from another
+            # worker's stream has had already
+            subscriber.sequence = max(self._sequence, seen if missed is not None else 0)
+            if last_event_id and missed is None:
+                subscriber.resync()
+            self._loops.setdefault(loop, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        loop = asyncio.get_running_loop()
+        subscriber.close()
+        with self._lock:
+            subscribers = self._loops.get(loop)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._loops[loop]
+
+
+class ChangePoller(object):
+    """
+    This class tails the model's change log on a thread, every
+    interval seconds, publishing each run of changes with the same
+    action as one event. Each process runs its own, started on first
+    use and again in a forked worker, like writer.py's thread
+    """
+    def __init__(self, model, broadcaster, interval=0.25, batch=1000):
+        """
+        :param model:       the Model whose change log is tailed
+        :param interval:    seconds between reads of the log
+        :param batch:       most changes read at once
+        """
+        self.model = model
+        self.broadcaster = broadcaster
+        self.interval = interval
+        self.batch = batch
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start tailing the log from its newest change, unless this
+        process already is
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                after = self._read(self.model.get_change_version)
+                self.broadcaster.begin(after)
+                thread = threading.Thread(target=self._run, args=(after,), name="change-poller")
+                thread.daemon = True
+                thread.start()
+                self._pid = os.getpid()
+
+    def _read(self, method, *args):
+        with app.app_context():
+            try:
+                return method(*args)
+            finally:
+                db.session.remove()
+
+    def _run(self, after):
+        while True:
+            time.sleep(self.interval)
+            try:
+                changes = self._read(self.model.get_change_log, after, self.batch)
+            except Exception as e:
+                app.logger.error(str(e), exc_info=True)
+                continue
+            if changes:
+                self._publish(after, changes)
+                after = changes[-1].id
+
+    def _publish(self, after, changes):
+        # the log drops its oldest changes, if it's dropped some we
+        # hadn't read the clients can't know what they changed
+        if changes[0].id > after + 1:
+            self.broadcaster.publish(changes[0].id - 1, RESYNC, [])
+        for action, run in groupby(changes, key=lambda change: change.action):
+            run = list(run)
+            self.broadcaster.publish(run[-1].id, action, [change.lname for change in run])
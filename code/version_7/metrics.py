@@ -0,0 +1,200 @@
+"""
+This module times the application's requests and hot paths
+into histograms, and serves them at /metrics in the Prometheus
+text format. Timing a span costs a couple of perf_counter calls
+and a short locked update, so it can stay on all the time.
+Each process keeps its own metrics
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import (
+    Response,
+    g,
+    request
+)
+
+
+# the histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+class Histogram(object):
+    """
+    This class counts observations into buckets
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Registry(object):
+    """
+    This class holds the histograms by metric name and labels,
+    along with collectors that report other values at scrape time
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.help = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, labels, help_text=""):
+        """
+        Get the histogram for name and labels, creating it the
+        first time it's used
+
+        :param labels:  tuple of (label, value) pairs
+        """
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+                self.help.setdefault(name, help_text)
+        return histogram
+
+    def add_collector(self, collector):
+        """
+        Add a function returning (name, type, help, [(labels, value)])
+        tuples for values that are read when /metrics is scraped
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """
+        Render all the metrics in the Prometheus text format
+        """
+        lines = []
+        by_name = {}
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            by_name.setdefault(name, []).append((labels, histogram))
+
+        for name, histograms in by_name.items():
+            lines.append("# HELP {} {}".format(name, self.help.get(name, "")))
+            lines.append("# TYPE {} histogram".format(name))
+            for labels, histogram in histograms:
+                counts, total = histogram.snapshot()
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, counts):
+                    cumulative += count
+                    le = format_labels(labels + (("le", repr(bound)),))
+                    lines.append("{}_bucket{} {}".format(name, le, cumulative))
+                cumulative += counts[-1]
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", "+Inf"),)), cumulative))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), repr(total)))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), cumulative))
+
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                for labels, value in samples:
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for label, value in labels
+    ) + "}"
+
+
+# the registry the application reports to
+REGISTRY = Registry()
+
+SPAN_METRIC = "names_span_seconds"
+REQUEST_METRIC = "names_request_seconds"
+
+
+@contextmanager
+def span(name):
+    """
+    Time the body of a with statement into the span histogram
+    """
+    histogram = REGISTRY.histogram(SPAN_METRIC, (("span", name),), "Time spent in hot path spans")
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+def timed(name):
+    """
+    Decorate a function so every call is timed as a span
+    """
+    def decorator(function):
+        histogram = REGISTRY.histogram(SPAN_METRIC, (("span", name),), "Time spent in hot path spans")
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def timed_handler(method):
+    """
+    Time a flask_restful resource method, without the dispatch,
+    swagger and response encoding work around it. Use it in a
+    Resource's method_decorators
+    """
+    return timed("handler." + method.__qualname__)(method)
+
+
+def init_app(app):
+    """
+    Time every request of app per endpoint, method and status,
+    and serve the metrics at /metrics
+    """
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def stop_timer(response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            labels = (
+                ("endpoint", request.endpoint or "unmatched"),
+                ("method", request.method),
+                ("status", str(response.status_code))
+            )
+            histogram = REGISTRY.histogram(REQUEST_METRIC, labels, "Time spent handling requests")
+            histogram.observe(time.perf_counter() - start)
+        return response
+
+    @app.route("/metrics")
+    def metrics():
+        """
+        This function responds to a request for /metrics with
+        the metrics in the Prometheus text format
+        """
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
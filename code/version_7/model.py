@@ -4,18 +4,96 @@ data methods (database access)
 """
 
 import os
+import sys
+from collections import namedtuple
+from datetime import datetime
 
 from application import app
 from flask_sqlalchemy import SQLAlchemy
+from metrics import timed
+from sqlalchemy import (
+    bindparam,
+    event,
+    func,
+    inspect,
+    select,
+    text
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import (
+    CreateIndex,
+    CreateTable
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm.exc import NoResultFound
 
 
 # create the database instance
 basepath = os.path.abspath(os.path.dirname(__file__))
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(basepath, "code.db")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = True
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get(
+    "NAMES_DATABASE_URI",
+    "sqlite:///" + os.path.join(basepath, "code.db")
+)
+
+# we don't use Flask-SQLAlchemy's per object modification tracking
+# and signals, Model.subscribe() tells us which names changed
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+# the pragmas every new SQLite connection runs. WAL lets readers
+# carry on while a writer commits, and with synchronous=NORMAL a
+# commit only appends to the log rather than waiting on an fsync,
+# the log is synced at checkpoints. busy_timeout makes a writer
+# wait up to that many milliseconds for another writer's lock
+# rather than fail straight away
+app.config.setdefault("SQLITE_PRAGMAS", {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -64 * 1024,
+    "busy_timeout": 5000
+})
+
+# each process keeps its own pool of connections, big enough for
+# one per thread serving requests (serve.py sets it to --threads)
+app.config.setdefault("NAMES_DB_POOL_SIZE", int(os.environ.get("NAMES_DB_POOL_SIZE", 8)))
+if ":memory:" not in app.config["SQLALCHEMY_DATABASE_URI"]:
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {
+        "pool_size": app.config["NAMES_DB_POOL_SIZE"],
+        "max_overflow": app.config["NAMES_DB_POOL_SIZE"],
+        "pool_timeout": 10
+    })
 db = SQLAlchemy(app)
 
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Run the configured pragmas on a new SQLite connection
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in app.config["SQLITE_PRAGMAS"].items():
+            cursor.execute("PRAGMA {}={}".format(pragma, value))
+    finally:
+        cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+
+# the operations a batch can contain, an upsert creates a name or
+# replaces the first name of an existing one
+BATCH_OPERATIONS = ("create", "upsert", "update", "delete")
+
+# number of last names bound to each IN (...) query, which keeps
+# us under SQLite's limit on bound variables per statement
+IN_QUERY_SIZE = 500
+
+# number of writes the change log keeps, a client whose version of
+# the list is older than them has to fetch the whole list again
+CHANGE_LOG_SIZE = 10000
+
+
 class Name(db.Model):
     '''
     This class encapsulates the names database
@@ -24,6 +102,11 @@ class Name(db.Model):
     fname = db.Column(db.String)
     timestamp = db.Column(db.TIMESTAMP)
 
+    # searches by first name read this index in (fname, lname) order
+    __table_args__ = (
+        db.Index("ix_name_fname_lname", "fname", "lname"),
+    )
+
     def __init__(self, last_name, first_name, timestamp):
         self.lname = last_name
         self.fname = first_name
@@ -31,42 +114,479 @@ class Name(db.Model):
 
     def __call__(self):
         # convert the data into a JSON serializeable dictionary
-        return {
-            "lname": self.lname,
-            "fname": self.fname,
-            "timestamp": self.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        }
+        return name_record(self)
+
+
+class NameChange(db.Model):
+    '''
+    This class is the log of the names written, one row per
+    insert, update and delete of a name. Triggers on the names
+    table fill it, so it has the writes of every process and
+    every write path, and its ids version the names list. action
+    is the write's create, update or delete, and changed its time,
+    in seconds since the epoch
+    '''
+    __tablename__ = "name_change"
+    id = db.Column(db.Integer, primary_key=True)
+    lname = db.Column(db.String)
+    changed = db.Column(db.Float)
+    action = db.Column(db.String)
+
+    # never reuse the ids of the pruned changes
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+# the names table, and the columns the read paths select from it
+NAMES = Name.__table__
+NAME_COLUMNS = (NAMES.c.lname, NAMES.c.fname, NAMES.c.timestamp)
+CHANGES = NameChange.__table__
+
+# the triggers logging every write to the names table, by name,
+# each one also drops the changes that fall out of the log
+CHANGE_TRIGGERS = {
+    "{}_{}_change".format(NAMES.name, event.lower()): """
+    CREATE TRIGGER IF NOT EXISTS {names}_{kind}_change AFTER {event} ON {names}
+    BEGIN
+        INSERT INTO {changes} (lname, action, changed)
+        VALUES ({row}.lname, '{action}', (julianday('now') - 2440587.5) * 86400.0);
+        DELETE FROM {changes} WHERE id <= (SELECT max(id) FROM {changes}) - {size};
+    END
+    """.format(names=NAMES.name, changes=CHANGES.name, kind=event.lower(), event=event, row=row,
+               action=action, size=CHANGE_LOG_SIZE)
+    for event, row, action in (
+        ("INSERT", "NEW", "create"),
+        ("UPDATE", "NEW", "update"),
+        ("DELETE", "OLD", "delete")
+    )
+}
+
+# a written name, as returned by the write methods, it has the
+# columns the read paths select
+NameRow = namedtuple("NameRow", ["lname", "fname", "timestamp"])
+
+
+def format_timestamp(timestamp):
+    """
+    Render a timestamp from the database as YYYY-MM-DD HH:MM:SS.
+    It isn't cached, the timestamps have microseconds so nearly
+    every one is different, and isoformat() is quicker than
+    rounding them to seconds for a cache key
+    """
+    return timestamp.isoformat(" ", "seconds")
+
+
+def name_record(name):
+    """
+    Convert a name, either a Name or a row selected from the
+    NAME_COLUMNS, into a JSON serializeable dictionary
+    """
+    return {
+        "lname": name.lname,
+        "fname": name.fname,
+        "timestamp": format_timestamp(name.timestamp)
+    }
+
+
+def trigger_sql(sql):
+    """
+    Normalize a trigger's CREATE statement to compare it with the
+    one SQLite keeps, which drops IF NOT EXISTS
+    """
+    return " ".join((sql or "").replace(" IF NOT EXISTS", "").split())
+
+
+def init_db():
+    """
+    Create the names and change log tables if they don't exist,
+    and any of the indexes, change log columns and triggers an
+    existing database is missing or has an older version of.
+    Every worker of an ASGI server can run this at once, so each
+    step tolerates another having just done it
+    """
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            connection.execute(CreateTable(table, if_not_exists=True))
+            for index in table.indexes:
+                connection.execute(CreateIndex(index, if_not_exists=True))
+
+        columns = {column["name"] for column in inspect(connection).get_columns(CHANGES.name)}
+        for column in CHANGES.columns:
+            if column.name in columns:
+                continue
+            try:
+                connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    CHANGES.name, column.name, column.type.compile(db.engine.dialect))))
+            except OperationalError:
+                if column.name not in {c["name"] for c in inspect(connection).get_columns(CHANGES.name)}:
+                    raise
+
+        query = text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'")
+        triggers = dict(connection.execute(query).all())
+        for name, trigger in CHANGE_TRIGGERS.items():
+            if name in triggers and trigger_sql(triggers[name]) != trigger_sql(trigger):
+                connection.execute(text("DROP TRIGGER IF EXISTS {}".format(name)))
+            connection.execute(text(trigger))
+
+
+def prefix_successor(prefix):
+    """
+    Get the smallest string greater than all the strings starting
+    with prefix, so a prefix match becomes an index range scan.
+    Characters without a successor, U+10FFFF, are dropped from the
+    end, and the surrogates, which can't be encoded, are skipped
+
+    :return:        the string, or None when every character of
+                    prefix is U+10FFFF and nothing is greater
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    successor = ord(prefix[-1]) + 1
+    if 0xD800 <= successor <= 0xDFFF:
+        successor = 0xE000
+    return prefix[:-1] + chr(successor)
+
+
+def match_column(column, value, prefix):
+    """
+    Build the filters matching column to value, or to strings
+    starting with value
+    """
+    if not prefix:
+        return [column == value]
+    if not value:
+        return []
+    successor = prefix_successor(value)
+    if successor is None:
+        return [column >= value]
+    return [column >= value, column < successor]
 
 
 class Model(object):
     """
     This class defines the access to the application
-    data
+    data, each query is timed as a span in metrics.py
+
+    The read methods select plain (lname, fname, timestamp) rows
+    through SQLAlchemy Core rather than loading Name objects, which
+    skips building and identity mapping an ORM object per row.
+    Turn them into dictionaries with name_record(). The single name
+    writes are one Core statement each too, and report a missing
+    name from the statement's rowcount rather than a query first
     """
+    def __init__(self):
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """
+        Call callback(action, last_names) after every committed
+        write, action is "create", "update" or "delete" and
+        last_names the list of names it changed
+        """
+        self._subscribers.append(callback)
+
+    def _notify(self, action, last_names):
+        # call after the commit, so subscribers see the new state
+        if not last_names:
+            return
+        for callback in list(self._subscribers):
+            try:
+                callback(action, last_names)
+            except Exception as e:
+                app.logger.error(str(e), exc_info=True)
+
+    @timed("model.get_names")
     def get_names(self):
-        return Name.query.all()
+        return db.session.execute(select(*NAME_COLUMNS)).all()
+
+    @timed("model.get_names_page")
+    def get_names_page(self, limit, after=None):
+        """
+        Get at most limit names ordered by last name, starting
+        after the last name passed in. Paging on the primary key
+        keeps each query an index range scan however big the table is
+        """
+        query = select(*NAME_COLUMNS)
+        if after is not None:
+            query = query.where(NAMES.c.lname > after)
+        return db.session.execute(query.order_by(NAMES.c.lname).limit(limit)).all()
+
+    def iter_names(self, batch_size=1000):
+        """
+        Generate all the names ordered by last name, reading them
+        a page at a time so only one page of rows is held at once
+        """
+        after = None
+        while True:
+            names = self.get_names_page(batch_size, after=after)
+            for name in names:
+                yield name
+            if len(names) < batch_size:
+                return
+            after = names[-1].lname
+
+    @timed("model.get_names_version")
+    def get_names_version(self):
+        """
+        Get the number of names and the id and time of the newest
+        change. Every create, update and delete logs a new change,
+        so they version the whole list, deletes included. SQLite
+        gives the bare changed column the value from the row max()
+        picked
+
+        :return:        (count, change id or None, seconds since the
+                        epoch or None)
+        """
+        count = select(func.count(NAMES.c.lname)).scalar_subquery()
+        query = select(count, func.max(CHANGES.c.id), CHANGES.c.changed)
+        return db.session.execute(query).one()
+
+    def get_versioned_names(self):
+        """
+        Get the version of the list and all the names. The version
+        is read first, so the names are never older than it
 
+        :return:        (get_names_version() tuple, get_names() rows)
+        """
+        return tuple(self.get_names_version()), self.get_names()
+
+    @timed("model.search_names")
+    def search_names(self, first_name=None, last_name=None, prefix=False, limit=100):
+        """
+        Get up to limit names whose first and/or last name match.
+        Searches by first name use the (fname, lname) index and are
+        ordered by it, searches by last name alone use the primary key
+
+        :param prefix:  match names starting with first_name and
+                        last_name, rather than equal to them
+        """
+        query = select(*NAME_COLUMNS)
+        if first_name is not None:
+            query = query.where(*match_column(NAMES.c.fname, first_name, prefix))
+        if last_name is not None:
+            query = query.where(*match_column(NAMES.c.lname, last_name, prefix))
+
+        if first_name is not None:
+            query = query.order_by(NAMES.c.fname, NAMES.c.lname)
+        else:
+            query = query.order_by(NAMES.c.lname)
+        return db.session.execute(query.limit(limit)).all()
+
+    @timed("model.get_changes")
+    def get_changes(self, since=None):
+        """
+        Get the names written after version since of the list, the
+        version being the id of the last change it has. The version
+        is read first, so a name written after it can come back with
+        its newer state, it comes back again with the next changes
+
+        :param since:   the version, None to get all the names
+        :return:        (the current version, the rows of the names
+                        created or updated, the last names deleted),
+                        or None when the change log doesn't go back
+                        to since
+        """
+        oldest, newest = db.session.execute(select(func.min(CHANGES.c.id), func.max(CHANGES.c.id))).one()
+        version = newest or 0
+        if since is None:
+            return version, self.get_names(), []
+
+        floor = oldest - 1 if oldest is not None else version
+        if not floor <= since <= version:
+            return None
+        query = select(CHANGES.c.lname).where(CHANGES.c.id > since, CHANGES.c.id <= version).distinct()
+        last_names = db.session.execute(query).scalars().all()
+
+        names = []
+        for start in range(0, len(last_names), IN_QUERY_SIZE):
+            chunk = last_names[start:start + IN_QUERY_SIZE]
+            names.extend(db.session.execute(select(*NAME_COLUMNS).where(NAMES.c.lname.in_(chunk))).all())
+        written = {name.lname for name in names}
+        return version, names, [last_name for last_name in last_names if last_name not in written]
+
+    def get_change_version(self):
+        """
+        Get the id of the newest change logged, 0 if there are none
+        """
+        return db.session.execute(select(func.max(CHANGES.c.id))).scalar() or 0
+
+    def get_change_log(self, after, limit=1000):
+        """
+        Get the changes logged after change id after, oldest first,
+        events.py tails the log with this
+
+        :return:        up to limit (id, lname, action) rows
+        """
+        query = select(CHANGES.c.id, CHANGES.c.lname, CHANGES.c.action).where(CHANGES.c.id > after)
+        return db.session.execute(query.order_by(CHANGES.c.id).limit(limit)).all()
+
+    @timed("model.get_name")
     def get_name(self, last_name):
-        return Name.query.filter_by(lname=last_name).one()
+        query = select(*NAME_COLUMNS).where(NAMES.c.lname == last_name)
+        return db.session.execute(query).one()
 
+    @timed("model.create_name")
     def create_name(self, last_name, first_name):
-        name = Name(last_name, first_name, datetime.now())
-        db.session.add(name)
-        db.session.commit()
-        return name
+        """
+        Create a name, or replace the first name of the one with the
+        same last name, in one INSERT ... ON CONFLICT DO UPDATE
+        statement rather than a query for the name and then a write
+        """
+        timestamp = datetime.now()
+        statement = sqlite_insert(NAMES).values(lname=last_name, fname=first_name, timestamp=timestamp)
+        statement = statement.on_conflict_do_update(
+            index_elements=[NAMES.c.lname],
+            set_={"fname": statement.excluded.fname, "timestamp": statement.excluded.timestamp}
+        )
+        self._execute(statement)
+        self._notify("create", [last_name])
+        return NameRow(last_name, first_name, timestamp)
 
+    @timed("model.update_name")
     def update_name(self, last_name, first_name=None):
-        name = Name.query.filter_by(lname=last_name).one()
-        name.lname = last_name
-        name.fname = first_name if first_name is not None else name.fname
-        db.session.add(name)
-        db.session.commit()
+        """
+        Update a name with one UPDATE ... WHERE lname = ? statement,
+        raising NoResultFound when it matched no row
+        """
+        timestamp = datetime.now()
+        values = {"timestamp": timestamp}
+        if first_name is not None:
+            values["fname"] = first_name
+        statement = NAMES.update().where(NAMES.c.lname == last_name).values(**values)
+        if first_name is None:
+            # the first name isn't changing, so read it back
+            statement = statement.returning(*NAME_COLUMNS)
+            name = self._execute(statement, returning=True)
+        else:
+            self._execute(statement)
+            name = NameRow(last_name, first_name, timestamp)
+        self._notify("update", [last_name])
         return name
 
+    @timed("model.delete_name")
     def delete_name(self, last_name):
-        name = Name.query.filter_by(lname=last_name).one()
-        db.session.delete(name)
-        db.session.commit()
+        """
+        Delete a name with one DELETE ... WHERE lname = ? statement,
+        raising NoResultFound when it matched no row
+        """
+        self._execute(NAMES.delete().where(NAMES.c.lname == last_name))
+        self._notify("delete", [last_name])
+
+    def _execute(self, statement, returning=False):
+        """
+        Execute a write statement and commit it, raising
+        NoResultFound if it wrote no row
+
+        :param returning:   whether the statement returns the row
+                            it wrote
+        :return:            that row, when returning
+        """
+        try:
+            result = db.session.execute(statement)
+            if returning:
+                row = result.one_or_none()
+                missing = row is None
+            else:
+                row = None
+                missing = result.rowcount == 0
+            if missing:
+                raise NoResultFound("No row was found")
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return row
+
+    @timed("model.apply_batch")
+    def apply_batch(self, operations, timestamp=None):
+        """
+        Apply a list of create, upsert, update and delete operations
+        in a single transaction. The operations are resolved in order
+        against the names they touch, and the net result is written
+        with one executemany per kind of statement
+
+        :param operations:  list of {"op": ..., "lname": ..., "fname": ...}
+        :param timestamp:   the time to stamp the written names with,
+                            now by default
+        :return:            list of {"op": ..., "lname": ..., "status": ...}
+                            dictionaries, one per operation, the ones
+                            creating or updating a name also have its
+                            resulting "fname"
+        """
+        last_names = list({
+            operation.get("lname") for operation in operations
+            if isinstance(operation, dict) and isinstance(operation.get("lname"), str)
+        })
+
+        # find out which of the names already exist
+        existing = {}
+        for start in range(0, len(last_names), IN_QUERY_SIZE):
+            chunk = last_names[start:start + IN_QUERY_SIZE]
+            rows = db.session.query(Name.lname, Name.fname).filter(Name.lname.in_(chunk))
+            existing.update(rows)
+
+        # work out each operation's status and the final first name
+        # of every name, None for the ones that end up deleted
+        state = dict(existing)
+        touched = set()
+        results = []
+        for operation in operations:
+            if not isinstance(operation, dict):
+                operation = {}
+            op = operation.get("op")
+            last_name = operation.get("lname")
+            first_name = operation.get("fname")
+            result = {"op": op, "lname": last_name}
+
+            if op not in BATCH_OPERATIONS or not last_name:
+                result.update(status=400, message="op must be one of create, upsert, update or delete with an lname")
+            elif not isinstance(last_name, str) or not isinstance(first_name, (str, type(None))):
+                result.update(status=400, message="lname and fname must be strings")
+            elif op == "create" and state.get(last_name) is not None:
+                result.update(status=409, message="Name already exists")
+            elif op in ("create", "upsert") and not first_name:
+                result.update(status=400, message="fname is required to create a name")
+            elif op in ("update", "delete") and state.get(last_name) is None:
+                result.update(status=404, message="Not found")
+            elif op == "delete":
+                state[last_name] = None
+                result.update(status=204)
+            else:
+                state[last_name] = first_name if first_name is not None else state[last_name]
+                touched.add(last_name)
+                result.update(status=200 if op == "update" else 201, fname=state[last_name])
+            results.append(result)
 
+        timestamp = timestamp or datetime.now()
+        deletes = [
+            {"b_lname": last_name} for last_name, first_name in state.items()
+            if first_name is None and last_name in existing
+        ]
+        inserts = [
+            {"lname": last_name, "fname": state[last_name], "timestamp": timestamp}
+            for last_name in touched
+            if state[last_name] is not None and last_name not in existing
+        ]
+        updates = [
+            {"lname": last_name, "fname": state[last_name], "timestamp": timestamp}
+            for last_name in touched
+            if state[last_name] is not None and last_name in existing
+        ]
 
+        try:
+            if deletes:
+                statement = Name.__table__.delete().where(Name.lname == bindparam("b_lname"))
+                db.session.execute(statement, deletes)
+            if inserts:
+                db.session.bulk_insert_mappings(Name, inserts)
+            if updates:
+                db.session.bulk_update_mappings(Name, updates)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
+        self._notify("create", [insert["lname"] for insert in inserts])
+        self._notify("update", [update["lname"] for update in updates])
+        self._notify("delete", [delete["b_lname"] for delete in deletes])
+        return results
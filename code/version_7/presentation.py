@@ -1,34 +1,309 @@
-# import python module to create timestamp
+# import python modules to create timestamps
 from datetime import datetime
+import os
+import time
+
+# import modules to page through and stream the names
+import base64
+import binascii
+import calendar
+from itertools import islice
 
 # import Flask, the Python micro web framework
 from flask import (
+    Response,
+    make_response,
     render_template,
     request,
-    jsonify
+    stream_with_context
  )
 
 # import the Flask API package
 from flask_restful import (
     Resource,
     Api,
-    abort
+    abort,
+    inputs,
+    reqparse
 )
 from flask_restful_swagger import swagger
+from sqlalchemy.orm.exc import NoResultFound
+from werkzeug.http import (
+    http_date,
+    quote_etag
+)
 
 # import the model to talk to the database
 from application import app
-from model import Model
+from model import (
+    Model,
+    init_db,
+    name_record
+)
+from cache import CachedModel
+import compression
+import encoding
+import metrics
+import profiler
+from encoding import (
+    dumps,
+    output_json
+)
+from events import (
+    Broadcaster,
+    ChangePoller
+)
+from metrics import (
+    REGISTRY,
+    span,
+    timed_handler
+)
+from profiler import profiled
+from writer import GroupCommitModel
+
+
+# the write mode, "direct" commits each write on its own, "group"
+# commits the writes from all the threads together, see writer.py
+app.config.setdefault("NAMES_WRITE_MODE", os.environ.get("NAMES_WRITE_MODE", "direct"))
+app.config.setdefault("NAMES_WRITE_DURABILITY", os.environ.get("NAMES_WRITE_DURABILITY", "commit"))
+app.config.setdefault("NAMES_WRITE_WINDOW", 0.002)
+app.config.setdefault("NAMES_WRITE_BATCH", 500)
+
+# create a model instance, with a read through cache in front of it.
+# Another worker's writes aren't seen until an entry expires, so keep
+# the time to live short, 0 turns the cache off (serve.py does with
+# more than one worker)
+app.config.setdefault("NAMES_CACHE_SIZE", 1024)
+app.config.setdefault("NAMES_CACHE_TTL", float(os.environ.get("NAMES_CACHE_TTL", 1.0)))
+model = Model()
+if app.config["NAMES_WRITE_MODE"] == "group":
+    model = GroupCommitModel(model,
+                             window=app.config["NAMES_WRITE_WINDOW"],
+                             max_batch=app.config["NAMES_WRITE_BATCH"],
+                             durability=app.config["NAMES_WRITE_DURABILITY"])
+MODEL = CachedModel(model,
+                    size=app.config["NAMES_CACHE_SIZE"],
+                    ttl=app.config["NAMES_CACHE_TTL"])
+
+# publish the committed writes of every worker as events, read from
+# the change log, asgi.py starts the poller and streams them
+app.config.setdefault("EVENTS_HISTORY", 1024)
+app.config.setdefault("EVENTS_QUEUE_SIZE", 256)
+app.config.setdefault("EVENTS_POLL_INTERVAL", float(os.environ.get("EVENTS_POLL_INTERVAL", 0.25)))
+BROADCASTER = Broadcaster(history=app.config["EVENTS_HISTORY"],
+                          queue_size=app.config["EVENTS_QUEUE_SIZE"])
+CHANGE_POLLER = ChangePoller(MODEL, BROADCASTER, interval=app.config["EVENTS_POLL_INTERVAL"])
+
+# make sure the names table and its indexes exist
+with app.app_context():
+    init_db()
+
+
+def to_epoch(timestamp):
+    """
+    Turn a timestamp from the database into seconds since the epoch
+    """
+    return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
+
+
+def list_validators(version):
+    """
+    Build the etag and modification time of a version of the
+    names list
+
+    :param version:     the (count, newest change id, time of the
+                        newest change) of the list
+    :return:            (the unquoted etag, seconds since the epoch or None)
+    """
+    count, change, changed = version
+    return "{:x}-{:x}".format(count, change or 0), changed
+
+
+def validator_headers(etag, last_modified):
+    """
+    Build the ETag and Last-Modified headers for a response
+
+    :param etag:            the unquoted etag
+    :param last_modified:   seconds since the epoch, or None
+    """
+    headers = {"ETag": quote_etag(etag)}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def not_modified(etag, last_modified):
+    """
+    Check the request's If-None-Match and If-Modified-Since headers
+    against the current etag and modification time, so a client
+    that is up to date gets a 304 before any payload is built
+
+    :return:        a 304 Not Modified response, or None if the
+                    client needs the payload
+    """
+    # If-None-Match uses the weak comparison, compressed responses
+    # carry a weak version of the etag
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since is not None and last_modified is not None:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        matched = int(last_modified) <= since
+    else:
+        matched = False
+
+    if not matched:
+        return None
+    rsp = make_response("", 304)
+    rsp.headers.extend(validator_headers(etag, last_modified))
+    return rsp
+
+
+# page sizes used when paging through the names list
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# parser for the paging arguments of the names list
+PAGE_PARSER = reqparse.RequestParser()
+PAGE_PARSER.add_argument("limit", type=int, location="args")
+PAGE_PARSER.add_argument("cursor", type=str, location="args")
+
+# parser for the search arguments of the names list
+SEARCH_PARSER = reqparse.RequestParser()
+SEARCH_PARSER.add_argument("fname", type=str, location="args")
+SEARCH_PARSER.add_argument("lname", type=str, location="args")
+SEARCH_PARSER.add_argument("prefix", type=inputs.boolean, location="args", default=False)
+
+
+def encode_cursor(last_name):
+    """
+    Turn the last name a page ended on into an opaque cursor
+    """
+    return base64.urlsafe_b64encode(last_name.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Turn an opaque cursor back into the last name a page ended on
+    """
+    try:
+        last_name = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        abort(400, message="Invalid cursor")
+
+    # urlsafe_b64decode() silently drops characters outside the
+    # alphabet, so only accept a cursor encode_cursor() could make
+    if encode_cursor(last_name) != cursor:
+        abort(400, message="Invalid cursor")
+    return last_name
+
+
+def get_page_arguments():
+    """
+    Get the paging arguments from the request
+
+    :return:        (limit, last name to start after), or (None, None)
+                    when the request didn't ask for a page
+    """
+    args = PAGE_PARSER.parse_args()
+    if args.limit is None and args.cursor is None:
+        return None, None
+
+    limit = args.limit if args.limit is not None else DEFAULT_PAGE_SIZE
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400, message="limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+
+    after = decode_cursor(args.cursor) if args.cursor else None
+    return limit, after
+
+
+def get_search_arguments():
+    """
+    Get the search arguments from the request
+
+    :return:        the parsed arguments, or None when the request
+                    isn't a search
+    """
+    args = SEARCH_PARSER.parse_args()
+    if args.fname is None and args.lname is None:
+        return None
+    if "cursor" in request.args:
+        abort(400, message="A search can't be paged with a cursor")
+    return args
+
+
+def validate_name(data, required):
+    """
+    Check a name record a client sent, asgi.py checks its bodies
+    with this too
+
+    :param required:    True if lname and fname must be there and
+                        not empty, otherwise they're optional
+    :raises ValueError: if the record isn't valid
+    """
+    if not isinstance(data, dict):
+        raise ValueError("The body must be a name record")
+    for field in ("lname", "fname"):
+        if data.get(field) is None:
+            if required:
+                raise ValueError("lname and fname are required")
+        elif not isinstance(data[field], str):
+            raise ValueError("{} must be a string".format(field))
+    if required and not (data["lname"] and data["fname"]):
+        raise ValueError("lname and fname are required")
+
+
+# most operations a single batch request can hold
+MAX_BATCH_SIZE = 10000
+
+# number of names encoded into each chunk of a streamed export
+EXPORT_CHUNK_SIZE = 1000
+
+
+def chunk_records(records):
+    """
+    Generate lists of at most EXPORT_CHUNK_SIZE records
+    """
+    records = iter(records)
+    chunk = list(islice(records, EXPORT_CHUNK_SIZE))
+    while chunk:
+        yield chunk
+        chunk = list(islice(records, EXPORT_CHUNK_SIZE))
 
 
-# create a model instance
-MODEL = Model()
+def stream_names(records, ndjson=False):
+    """
+    Generate the names as a JSON array, or as newline delimited
+    JSON, a chunk of records at a time so the whole document is
+    never built in memory
+
+    :param records:     iterable of name dictionaries
+    :param ndjson:      generate one JSON document per line
+    """
+    if ndjson:
+        for chunk in chunk_records(records):
+            yield b"".join(dumps(record) + b"\n" for record in chunk)
+        return
+
+    yield b"["
+    separator = b""
+    for chunk in chunk_records(records):
+        yield separator + b",".join(dumps(record) for record in chunk)
+        separator = b","
+    yield b"]"
 
 
 class Names(Resource):
     """
     Our Name API
     """
+    # only the reads can be profiled, a profiled write would commit
+    # and answer with the profile rather than the written record
+    method_decorators = {
+        "get": [timed_handler, profiled],
+        "put": [timed_handler],
+        "delete": [timed_handler]
+    }
+
     def __init__(self):
         self.model = MODEL
 
@@ -48,24 +323,39 @@ class Names(Resource):
             {
                 'code': 200,
                 'message': 'Retrieved the requested name'
+            },
+            {
+                'code': 304,
+                'message': 'The name has not changed since the If-None-Match etag or If-Modified-Since time'
+            },
+            {
+                'code': 404,
+                'message': 'Not found'
             }
         ]
     )
     def get(self, last_name):
         """Get a particular name record"""
-        # did we get an endpoint parameter?
+        # any other error is a 500, without validators a client could cache
         try:
-            if last_name is not None:
-                retval = MODEL.get_name(last_name)
+            retval = MODEL.get_name(last_name)
+        except NoResultFound:
+            # nope, didn't find the resource
+            abort(404)
 
-            # otherwise, nope, didn't find the resource
-            else:
-                abort(404, )
-        except Exception as e:
-            app.logger.error(e.message, exc_info=True)
+        # the record's timestamp changes with every write, so it
+        # versions the record
+        last_modified = to_epoch(retval.timestamp)
+        etag = "{:x}".format(int(last_modified * 1e6))
+
+        # does the client already have this version of the record?
+        rsp = not_modified(etag, last_modified)
+        if rsp is not None:
+            return rsp
 
-        retval = jsonify(retval)
-        return retval
+        with span("serialize.name"):
+            retval = name_record(retval)
+        return retval, 200, validator_headers(etag, last_modified)
 
     @swagger.operation(
         notes='update a name in the data structure',
@@ -91,28 +381,44 @@ class Names(Resource):
             {
                 'code': 204,
                 'message': 'Name record updated'
+            },
+            {
+                'code': 202,
+                'message': 'Update queued, with enqueue write durability'
+            },
+            {
+                'code': 400,
+                'message': 'Invalid input'
+            },
+            {
+                'code': 404,
+                'message': 'Not found'
             }
         ]
     )
     def put(self, last_name):
         """Update a name record"""
-        name = None
+        # get the PUT JSON data
+        put_data = request.get_json(silent=True)
+        try:
+            validate_name(put_data, required=False)
+        except ValueError as e:
+            abort(400, message=str(e))
 
+        # the UPDATE's rowcount tells us if the record exists, without
+        # an fname only the timestamp changes
         try:
-            # did we get a valid name?
-            if last_name is not None:
-                # get the PUT JSON data
-                put_data = request.get_json()
-                name = MODEL.update_name(last_name, first_name=put_data.get("fname", ""))
-
-            # otherwise, nope, didn't find the record
-            else:
-                abort(404)
-        except Exception as e:
-            app.logger.error(e.message, exc_info=True)
+            name = MODEL.update_name(last_name, first_name=put_data.get("fname"))
+        except NoResultFound:
+            abort(404)
+
+        # with enqueue durability the write is only queued, there's
+        # no record to return yet
+        if name is None:
+            return make_response("", 202)
 
         # return the updated record
-        return name(), 201
+        return name_record(name), 201
 
     @swagger.operation(
         notes='delete a name from the data structure',
@@ -141,17 +447,11 @@ class Names(Resource):
         """
         Deletes a record from the names structure
         """
+        # the DELETE's rowcount tells us if the record existed
         try:
-            # did we get a valid name?
-            if last_name is not None:
-                MODEL.delete_name(last_name)
-                del self.names[last_name]
-
-            # otherwise, nope, didn't find the record
-            else:
-                abort(404)
-        except Exception as e:
-            app.logger.error(e.message, exc_info=True)
+            MODEL.delete_name(last_name)
+        except NoResultFound:
+            abort(404)
 
         return "", 204
 
@@ -160,34 +460,117 @@ class NamesList(Resource):
     """
     Our NameList API
     """
+    method_decorators = {
+        "get": [timed_handler, profiled],
+        "post": [timed_handler]
+    }
+
     def __init__(self):
         self.model = MODEL
 
     @swagger.operation(
         notes='This method gets the list of all names from the data structure',
         nickname='Read',
+        parameters=[
+            {
+                'name': 'limit',
+                'description': 'The maximum number of names to return in a page',
+                'required': False,
+                'dataType': 'integer',
+                'paramType': 'query'
+            },
+            {
+                'name': 'cursor',
+                'description': 'The next cursor returned by the previous page',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            },
+            {
+                'name': 'fname',
+                'description': 'Search for names with this first name',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            },
+            {
+                'name': 'lname',
+                'description': 'Search for names with this last name',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            },
+            {
+                'name': 'prefix',
+                'description': 'Search for names starting with fname and lname',
+                'required': False,
+                'dataType': 'boolean',
+                'paramType': 'query'
+            }
+        ],
         responseMessages=[
             {
                 'code': 200,
                 'message': 'Retrieved the entire names list'
+            },
+            {
+                'code': 304,
+                'message': 'The list has not changed since the If-None-Match etag or If-Modified-Since time'
+            },
+            {
+                'code': 400,
+                'message': 'Invalid limit or cursor'
             }
         ]
     )
     def get(self):
         """
-        Get the entire list of names
+        Get the entire list of names, a page of it ordered by
+        last name when a limit or cursor is passed, or the names
+        matching a search by fname and/or lname
         """
-        retval = None
-        try:
-            names = MODEL.get_names()
-            retval = [name() for name in names]
-        except Exception as e:
-            app.logger.error(e.message, exc_info=True)
-
-        return retval
+        limit, after = get_page_arguments()
+        search = get_search_arguments()
+
+        # the number of names and the newest change version the list
+        etag, last_modified = list_validators(MODEL.get_names_version())
+
+        # does the client already have this version of the list?
+        rsp = not_modified(etag, last_modified)
+        if rsp is not None:
+            return rsp
+
+        # a failed query is a 500, never a payload with this version's validators
+        if search is not None:
+            names = MODEL.search_names(first_name=search.fname,
+                                       last_name=search.lname,
+                                       prefix=search.prefix,
+                                       limit=limit or MAX_PAGE_SIZE)
+            with span("serialize.names"):
+                retval = [name_record(name) for name in names]
+
+        # the whole list goes out with the validators of the version
+        # it was read at, which can be newer than the one checked
+        elif limit is None:
+            version, names = MODEL.get_versioned_names()
+            etag, last_modified = list_validators(version)
+            with span("serialize.names"):
+                retval = [name_record(name) for name in names]
+
+        # ask for one extra name, it tells us if there is another page
+        else:
+            names = MODEL.get_names_page(limit + 1, after=after)
+            next_cursor = encode_cursor(names[limit - 1].lname) if len(names) > limit else None
+            with span("serialize.names"):
+                retval = {
+                    "names": [name_record(name) for name in names[:limit]],
+                    "next": next_cursor
+                }
+
+        return retval, 200, validator_headers(etag, last_modified)
 
     @swagger.operation(
-        notes='create a new name in the data structure',
+        notes='create a new name in the data structure, or replace the first name of an existing one',
         nickname='Create',
         contentType='application/json',
         parameters=[
@@ -205,26 +588,202 @@ class NamesList(Resource):
                 'message': 'Created the new name record',
             },
             {
-                'code': 405,
+                'code': 202,
+                'message': 'Name queued, with enqueue write durability'
+            },
+            {
+                'code': 400,
+                'message': 'Invalid input'
+            }
+        ]
+    )
+    def post(self):
+        """
+        Create a new record in the names structure, or replace the
+        first name of the record with the same last name
+        """
+        # get the POST JSON data
+        post_data = request.get_json(silent=True)
+        try:
+            validate_name(post_data, required=True)
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        # insert the name, or update it if it's already there
+        name = MODEL.create_name(post_data["lname"], first_name=post_data["fname"])
+
+        # only queued with enqueue durability, there's no record yet
+        if name is None:
+            return make_response("", 202)
+
+        # return the newly created record
+        return name_record(name), 201
+
+
+class NamesExport(Resource):
+    """
+    Our NameExport API
+    """
+    method_decorators = [timed_handler]
+
+    def __init__(self):
+        self.model = MODEL
+
+    @swagger.operation(
+        notes='This method streams the list of all names from the data structure',
+        nickname='Export',
+        parameters=[
+            {
+                'name': 'format',
+                'description': 'json for a JSON array (the default) or ndjson for one name per line',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            }
+        ],
+        responseMessages=[
+            {
+                'code': 200,
+                'message': 'Streamed the entire names list'
+            },
+            {
+                'code': 400,
+                'message': 'Invalid format'
+            }
+        ]
+    )
+    def get(self):
+        """
+        Stream the entire list of names
+        """
+        export_format = request.args.get("format", "json")
+        if export_format not in ("json", "ndjson"):
+            abort(400, message="format must be json or ndjson")
+
+        records = (name_record(name) for name in MODEL.iter_names())
+        ndjson = export_format == "ndjson"
+        return Response(
+            stream_with_context(stream_names(records, ndjson=ndjson)),
+            mimetype="application/x-ndjson" if ndjson else "application/json"
+        )
+
+
+class NamesChanges(Resource):
+    """
+    Our NamesChanges API
+    """
+    method_decorators = [timed_handler]
+
+    def __init__(self):
+        self.model = MODEL
+
+    @swagger.operation(
+        notes='This method gets the names written since a version of the list, so a client can keep its copy '
+              'of the list up to date without fetching all of it. Without since it returns all the names',
+        nickname='Changes',
+        parameters=[
+            {
+                'name': 'since',
+                'description': 'The version returned by the previous call',
+                'required': False,
+                'dataType': 'string',
+                'paramType': 'query'
+            }
+        ],
+        responseMessages=[
+            {
+                'code': 200,
+                'message': 'The version of the list, the names created or updated and the last names deleted'
+            },
+            {
+                'code': 410,
+                'message': 'The changes since that version are gone, fetch them all without since'
+            }
+        ]
+    )
+    def get(self):
+        """
+        Get the changes to the names since a version of the list
+        """
+        return get_changes(request.args.get("since"))
+
+
+def get_changes(since):
+    """
+    Get the changes to the names since a version of the list, for
+    NamesChanges and asgi.py
+
+    :param since:       the version the client has, None for all the names
+    :return:            {"version": ..., "names": [...], "deleted": [...]}
+    """
+    # the version is the id of the list's last change, which the
+    # change log may no longer reach
+    changes = None
+    if since is None or since.isdigit():
+        changes = MODEL.get_changes(int(since) if since is not None else None)
+    if changes is None:
+        abort(410, message="The changes since {} are gone, fetch all the names".format(since))
+
+    version, names, deleted = changes
+    with span("serialize.names"):
+        return {
+            "version": str(version),
+            "names": [name_record(name) for name in names],
+            "deleted": deleted
+        }
+
+
+class NamesBatch(Resource):
+    """
+    Our NameBatch API
+    """
+    method_decorators = [timed_handler]
+
+    def __init__(self):
+        self.model = MODEL
+
+    @swagger.operation(
+        notes='apply a list of create, update and delete operations to the data structure in one transaction',
+        nickname='Batch',
+        contentType='application/json',
+        parameters=[
+            {
+                'name': 'body',
+                'description': 'A list of {"op": "create|upsert|update|delete", "lname": ..., "fname": ...} operations',
+                'required': True,
+                'type': 'list',
+                'paramType': 'body'
+            }
+        ],
+        responseMessages=[
+            {
+                'code': 200,
+                'message': 'Applied the batch, the body has the status of each operation'
+            },
+            {
+                'code': 400,
                 'message': 'Invalid input'
             }
         ]
     )
     def post(self):
         """
-        Create a new record in the names structure
+        Apply a batch of operations to the names structure
         """
         # get the POST JSON data
-        post_data = request.get_json()
+        operations = request.get_json()
+        if not isinstance(operations, list):
+            abort(400, message="The body must be a list of operations")
+        if len(operations) > MAX_BATCH_SIZE:
+            abort(400, message="A batch can hold at most {} operations".format(MAX_BATCH_SIZE))
 
-        # update the list of names
         try:
-            name = MODEL.create_name(post_data["lname"], first_name=post_data["fname"])
+            results = MODEL.apply_batch(operations)
         except Exception as e:
-            app.logger.error(e.message, exc_info=True)
+            app.logger.error(str(e), exc_info=True)
+            abort(500, message="The batch was not applied")
 
-        # return the newly created record
-        return name(), 201
+        return results
 
 
 # connect the flask restful system into the application along with Swagger
@@ -235,9 +794,49 @@ api = swagger.docs(Api(app),
 
 # connect our Names classes to the API processing
 api.add_resource(NamesList, "/api/names")
+api.add_resource(NamesExport, "/api/names/export")
+api.add_resource(NamesChanges, "/api/names/changes")
+api.add_resource(NamesBatch, "/api/names/batch")
 api.add_resource(Names, "/api/names/<string:last_name>")
 
 
+@api.representation("application/json")
+def timed_output_json(data, code, headers=None):
+    """
+    Encode a resource's response as JSON with the fastest encoder
+    installed, timing the encoder
+    """
+    with span("encode.json"):
+        return output_json(data, code, headers)
+
+
+def cache_metrics():
+    """
+    Report the model cache's counters along with the timings
+    """
+    stats = MODEL.cache.stats()
+    return [
+        ("names_cache_hits_total", "counter", "Model cache hits", [((), stats["hits"])]),
+        ("names_cache_misses_total", "counter", "Model cache misses", [((), stats["misses"])]),
+        ("names_cache_entries", "gauge", "Names in the model cache", [((), stats["entries"])])
+    ]
+
+
+# make jsonify() use the fast encoder too
+encoding.init_app(app)
+
+# time every request and serve the metrics at /metrics
+REGISTRY.add_collector(cache_metrics)
+metrics.init_app(app)
+
+# profile on demand, when a PROFILER_TOKEN is configured
+profiler.init_app(app)
+
+# compress the responses the client accepts compressed, after
+# the metrics hooks so the request timings include it
+compression.init_app(app)
+
+
 # create a URL route in our application for "/"
 @app.route('/')
 def hello_world():
@@ -0,0 +1,151 @@
+"""
+This module profiles a live application on demand. It's off
+unless the PROFILER_TOKEN configuration value is set, and every
+request has to send that token in an X-Profiler-Token header.
+
+    GET /admin/profile?seconds=10
+
+samples the stacks of all the process's threads for the given
+number of seconds and returns them collapsed, one stack per line
+with the number of times it was seen, ready for flamegraph.pl
+or speedscope. Adding ?__profile=1 to a request of a resource
+using the profiled method decorator runs that one call under
+cProfile and returns its pstats report instead of the response
+"""
+
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import (
+    Response,
+    current_app,
+    request
+)
+from flask_restful import abort
+
+
+# the longest a sampling profile can run, in seconds
+MAX_PROFILE_SECONDS = 60
+
+# number of functions listed in a pstats report
+PSTATS_LINES = 50
+
+# only one sampling profile runs at a time
+PROFILE_LOCK = threading.Lock()
+
+
+def check_token():
+    """
+    Abort the request unless profiling is enabled and the request
+    carries the profiler token
+
+    :return:        None
+    """
+    token = current_app.config.get("PROFILER_TOKEN")
+    if not token:
+        abort(404)
+    sent = request.headers.get("X-Profiler-Token", "")
+    if not hmac.compare_digest(sent.encode("utf-8"), token.encode("utf-8")):
+        abort(401, message="A valid X-Profiler-Token header is required")
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def sample_stacks(seconds, interval):
+    """
+    Sample the stacks of every other thread of the process every
+    interval seconds, for seconds seconds
+
+    :return:        Counter of collapsed stacks, root frame first
+    """
+    stacks = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frame_name(frame))
+                frame = frame.f_back
+            frames.append(names.get(ident, "thread-{}".format(ident)))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def pstats_report(profile):
+    """
+    Render the functions a cProfile run spent the most time in
+    """
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats("cumulative").print_stats(PSTATS_LINES)
+    return output.getvalue()
+
+
+def profiled(method):
+    """
+    Run a flask_restful resource method under cProfile when the
+    request has ?__profile=1. Use it in a Resource's method_decorators
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        # without a token the parameter is ignored, as if profiling didn't exist
+        if request.args.get("__profile") != "1" or not current_app.config.get("PROFILER_TOKEN"):
+            return method(*args, **kwargs)
+
+        check_token()
+        profile = cProfile.Profile()
+        profile.runcall(method, *args, **kwargs)
+        return Response(pstats_report(profile), mimetype="text/plain")
+    return wrapper
+
+
+def init_app(app):
+    """
+    Add the /admin/profile sampling profiler route to app
+    """
+    app.config.setdefault("PROFILER_TOKEN", os.environ.get("PROFILER_TOKEN"))
+    app.config.setdefault("PROFILER_SAMPLE_INTERVAL", 0.005)
+
+    @app.route("/admin/profile")
+    def profile():
+        """
+        This function responds to a request for /admin/profile
+        with the collapsed stacks of the process's other threads,
+        sampled for ?seconds=N (1 by default). The request holds its
+        worker thread for the whole profile
+        """
+        check_token()
+        try:
+            seconds = float(request.args.get("seconds", 1))
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            abort(400, message="seconds must be between 0 and {}".format(MAX_PROFILE_SECONDS))
+
+        if not PROFILE_LOCK.acquire(False):
+            abort(409, message="A profile is already running")
+        try:
+            stacks = sample_stacks(seconds, app.config["PROFILER_SAMPLE_INTERVAL"])
+        finally:
+            PROFILE_LOCK.release()
+
+        collapsed = "".join(
+            "{} {}\n".format(stack, count) for stack, count in stacks.most_common()
+        )
+        return Response(collapsed, mimetype="text/plain")
@@ -0,0 +1,224 @@
+"""
+This module funnels the model's writes through a single writer
+thread, which commits everything that arrives within a short
+window, up to a maximum number of operations, in one transaction
+with Model.apply_batch(). SQLite then syncs once per batch
+rather than once per write.
+
+Set NAMES_WRITE_MODE to "group" to use it. NAMES_WRITE_DURABILITY
+picks when a write returns: "commit", the default, waits until
+its batch has committed, "enqueue" returns as soon as the write
+is queued, so a write can be lost if the process dies before
+the batch commits, and a request that reads straight after
+writing may not see its own write yet. There's no record to
+return for a queued write, so the resources answer 202 Accepted
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from functools import partial
+
+from sqlalchemy.orm.exc import NoResultFound
+
+from application import app
+from model import (
+    NameRow,
+    db
+)
+
+
+# the durability modes
+COMMIT = "commit"
+ENQUEUE = "enqueue"
+
+# marker that stops the writer thread
+STOP = object()
+
+
+class GroupCommitWriter(object):
+    """
+    This class runs the writer thread. Each operation is queued
+    with a Future the thread resolves with the operation's result
+    from apply_batch() once its batch has committed. When a batch
+    fails to commit its operations are retried one at a time, so
+    only the one at fault fails
+    """
+    def __init__(self, model, window=0.002, max_batch=500):
+        """
+        :param model:       the Model whose apply_batch() writes
+        :param window:      seconds the thread waits after the first
+                            operation of a batch for more to arrive
+        :param max_batch:   most operations committed at once
+        """
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # start the thread on first use, and again in a forked
+        # worker process, which doesn't inherit its parent's threads
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name="group-commit-writer")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def submit(self, operation):
+        """
+        Queue an operation
+
+        :param operation:   {"op": ..., "lname": ..., "fname": ...}
+        :return:            Future of the operation's result
+        """
+        if self._pid != os.getpid():
+            self._start()
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def stop(self):
+        """
+        Commit everything queued so far and stop the thread
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(STOP)
+            self._thread.join()
+
+    def _next_batch(self):
+        # block for the first operation, then gather any more that
+        # arrive within the window
+        item = self._queue.get()
+        if item is STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                continue
+
+            operations = [operation for operation, future in batch]
+            timestamp = datetime.now()
+            try:
+                results = self._apply(operations, timestamp)
+            except Exception as e:
+                # don't fail every write for the sake of one, retry
+                # them one at a time so each gets its own result
+                app.logger.error(str(e), exc_info=True)
+                self._apply_each(batch, timestamp)
+                continue
+
+            for (operation, future), result in zip(batch, results):
+                result["timestamp"] = timestamp
+                future.set_result(result)
+
+    def _apply(self, operations, timestamp):
+        with app.app_context():
+            try:
+                return self.model.apply_batch(operations, timestamp=timestamp)
+            finally:
+                db.session.remove()
+
+    def _apply_each(self, batch, timestamp):
+        # commit each operation of a failed batch on its own, in order
+        for operation, future in batch:
+            try:
+                result, = self._apply([operation], timestamp)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            result["timestamp"] = timestamp
+            future.set_result(result)
+
+
+class GroupCommitModel(object):
+    """
+    This class wraps a Model, sending create_name, update_name and
+    delete_name through a GroupCommitWriter. They raise and return
+    what the Model's do, except that with ENQUEUE durability
+    create_name and update_name return None, the write has only
+    been queued
+    """
+    def __init__(self, model, window=0.002, max_batch=500, durability=COMMIT):
+        if durability not in (COMMIT, ENQUEUE):
+            raise ValueError("durability must be {} or {}".format(COMMIT, ENQUEUE))
+        self.model = model
+        self.durability = durability
+        self.writer = GroupCommitWriter(model, window=window, max_batch=max_batch)
+        atexit.register(self.writer.stop)
+
+    def __getattr__(self, attribute):
+        # reads go straight to the model
+        return getattr(self.model, attribute)
+
+    def _write(self, operation):
+        # check the operation before it's queued, so a bad one fails
+        # its caller rather than the batch it would have joined
+        if not isinstance(operation["lname"], str) or not isinstance(operation.get("fname"), (str, type(None))):
+            raise ValueError("lname and fname must be strings")
+
+        future = self.writer.submit(operation)
+        if self.durability == ENQUEUE:
+            future.add_done_callback(partial(log_failure, operation))
+            return None
+
+        result = future.result()
+        if result["status"] == 404:
+            raise NoResultFound(result["message"])
+        if result["status"] >= 400:
+            raise ValueError(result["message"])
+        return result
+
+    def create_name(self, last_name, first_name):
+        result = self._write({"op": "upsert", "lname": last_name, "fname": first_name})
+        if result is None:
+            return None
+        return NameRow(last_name, result["fname"], result["timestamp"])
+
+    def update_name(self, last_name, first_name=None):
+        result = self._write({"op": "update", "lname": last_name, "fname": first_name})
+        if result is None:
+            return None
+        return NameRow(last_name, result["fname"], result["timestamp"])
+
+    def delete_name(self, last_name):
+        self._write({"op": "delete", "lname": last_name})
+
+
+def log_failure(operation, future):
+    """
+    Log the failure of a write no caller waited for, either its
+    batch raised or the write was refused
+    """
+    exception = future.exception()
+    if exception is not None:
+        app.logger.error("queued %s of %s failed: %s", operation["op"], operation["lname"], exception,
+                         exc_info=exception)
+        return
+    result = future.result()
+    if result["status"] >= 400:
+        app.logger.error("queued %s of %s failed: %s", result["op"], result["lname"], result.get("message"))